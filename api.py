@@ -0,0 +1,382 @@
+"""Versioned JSON API for accounts, entries and transfers.
+
+Rows are validated with the forms in forms.py, so the API accepts
+exactly what the HTML forms do. A POST body is either one object or a
+list of up to MAX_BATCH objects; a list is validated as a whole and
+then written in a single transaction, so either every row is created
+or none is. Money is sent and returned as strings (numbers are also
+accepted), dates as YYYY-MM-DD.
+
+Entries and transfers may carry an ``idempotency_key``, or take one
+from the Idempotency-Key header. A POST that is retried with the same
+keys returns the rows created the first time, with status 200, and
+writes nothing. A key used again for a row with other values is
+refused with status 422.
+"""
+import datetime
+
+from flask import Blueprint, jsonify, request
+from werkzeug.datastructures import MultiDict
+
+from forms import CreateAccountForm, CreateEntryForm, CreateTransferForm
+from models import (Account, count_inserts, Entry, IdempotencyKeyReused,
+                    Transfer)
+from pagination import paginate, PER_PAGE
+import search
+import write_queue
+
+MAX_BATCH = 1000
+MAX_PER_PAGE = 500
+
+blueprint = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+class ApiError(Exception):
+    def __init__(self, status, **body):
+        Exception.__init__(self, status, body)
+        self.status = status
+        self.body = body
+
+
+@blueprint.errorhandler(ApiError)
+def api_error(e):
+    response = jsonify(**e.body)
+    response.status_code = e.status
+    return response
+
+
+def account_json(account):
+    return {
+        'id': account.id,
+        'name': account.name,
+        'balance': str(account.balance),
+        'opening_balance': str(account.opening_balance),
+        'accnt_type': account.accnt_type,
+        'bank': account.bank,
+    }
+
+
+def entry_json(entry):
+    return {
+        'id': entry.id,
+        'descrip': entry.descrip,
+        'date': str(entry.date),
+        'tranact_type': entry.tranact_type,
+        'amount': str(entry.amount),
+        'account_id': entry.assc_accnt_id,
+        'idempotency_key': entry.idempotency_key,
+    }
+
+
+def transfer_json(transfer):
+    return {
+        'id': transfer.id,
+        'descrip': transfer.descrip,
+        'date': str(transfer.date),
+        'amount': str(transfer.amount),
+        'from_account_id': transfer.from_accnt_id,
+        'to_account_id': transfer.to_accnt_id,
+        'idempotency_key': transfer.idempotency_key,
+    }
+
+
+class Resource(object):
+    """Maps the JSON fields of a resource onto the fields of its form.
+
+    ``fields`` pairs each JSON name with the form field it fills, and
+    ``account_fields`` lists the form fields that take an account id.
+    ``create(rows)`` writes a list of validated form data, and returns
+    the new rows.
+    """
+    def __init__(self, form_class, fields, create, to_json,
+                 account_fields=()):
+        self.form_class = form_class
+        self.fields = fields
+        self.create = create
+        self.to_json = to_json
+        self.account_fields = account_fields
+
+    def validate(self, form, row):
+        """Validates one JSON object with ``form``, and returns the
+        form's data or, if the object is invalid, the errors keyed by
+        JSON name.
+        """
+        if not isinstance(row, dict):
+            return None, {'': ['Expected a JSON object.']}
+        formdata = MultiDict(
+            (field, str(row[name])) for name, field in self.fields.items()
+            if row.get(name) is not None)
+        form.process(formdata)
+        if self.account_fields:
+            choices = Account.cached_choices(*[
+                formdata.get(field) for field in self.account_fields])
+            for field in self.account_fields:
+                form[field].choices = choices
+        if form.validate():
+            return form.data, None
+        names = dict((field, name) for name, field in self.fields.items())
+        return None, dict((names.get(field, field), errors)
+                          for field, errors in form.errors.items())
+
+    def post(self):
+        """Validates and creates the row or rows in the request body."""
+        body = request.get_json(silent=True)
+        if body is None:
+            raise ApiError(400, error='Expected a JSON body.')
+        rows = body if isinstance(body, list) else [body]
+        if len(rows) > MAX_BATCH:
+            raise ApiError(413, error='At most {} rows per request.'.format(
+                MAX_BATCH))
+        if 'idempotency_key' in self.fields:
+            rows = self.with_idempotency_keys(
+                rows, request.headers.get('Idempotency-Key'),
+                isinstance(body, list))
+
+        # One form checks every row; building a form is the costly part
+        # of validating one.
+        form = self.form_class(formdata=None, meta={'csrf': False})
+        valid, errors = [], []
+        for index, row in enumerate(rows):
+            data, row_errors = self.validate(form, row)
+            if row_errors:
+                errors.append({'index': index, 'errors': row_errors})
+            valid.append(data)
+        if errors:
+            raise ApiError(400, errors=errors)
+
+        try:
+            created = self.create(valid)
+        except IdempotencyKeyReused as e:
+            raise ApiError(422, errors=[
+                {'index': index, 'errors': {'idempotency_key': [str(e)]}}
+                for index, row in enumerate(valid)
+                if row['idempotency_key'] == e.key])
+        items = [self.to_json(row) for row in created]
+        response = (jsonify(items=items) if isinstance(body, list)
+                    else jsonify(**items[0]))
+        # A retry that created nothing new gets the original rows back.
+        replayed = all(getattr(row, 'replayed', False) for row in created)
+        response.status_code = 200 if created and replayed else 201
+        return response
+
+    @staticmethod
+    def with_idempotency_keys(rows, key, batch):
+        """Gives rows without an ``idempotency_key`` of their own the
+        request's Idempotency-Key header, followed by ``:<index>`` in a
+        batch.
+        """
+        if key is None:
+            return rows
+        return [
+            dict(row, idempotency_key='{}:{}'.format(key, index)
+                 if batch else key)
+            if isinstance(row, dict) and row.get('idempotency_key') is None
+            else row
+            for index, row in enumerate(rows)]
+
+
+def _create_accounts(rows):
+    created = []
+    with Account._meta.database.transaction():
+        for index, row in enumerate(rows):
+            try:
+                created.append(Account.create_account(
+                    name=row['name'].strip(),
+                    balance=row['balance'],
+                    accnt_type=row['accnt_type'],
+                    bank=row['bank'].strip(),
+                ))
+            except ValueError as e:
+                # Two rows of the batch with the same name.
+                raise ApiError(409, errors=[
+                    {'index': index, 'errors': {'name': [str(e)]}}])
+    return created
+
+
+def _entry(row):
+    return {
+        'descrip': row['descrip'],
+        'date': row['date'],
+        'tranact_type': row['tranact_type'],
+        'amount': row['amount'],
+        'assc_accnt': Account.cached(row['assc_accnt']),
+        'idempotency_key': row['idempotency_key'] or None,
+    }
+
+
+def _transfer(row):
+    return {
+        'descrip': row['descrip'],
+        'date': row['date'],
+        'amount': row['amount'],
+        'from_accnt': Account.cached(row['from_accnt']),
+        'to_accnt': Account.cached(row['to_accnt']),
+        'idempotency_key': row['idempotency_key'] or None,
+    }
+
+
+def _create_entries(rows):
+    # A single row may go through the write queue; a batch is already
+    # one transaction.
+    if len(rows) == 1:
+        return [write_queue.write(Entry, **_entry(rows[0]))]
+    entries = Entry.create_entries([_entry(row) for row in rows])
+    count_inserts(entries)
+    return entries
+
+
+def _create_transfers(rows):
+    if len(rows) == 1:
+        return [write_queue.write(Transfer, **_transfer(rows[0]))]
+    transfers = Transfer.create_transfers([_transfer(row) for row in rows])
+    count_inserts(transfers)
+    return transfers
+
+
+ACCOUNTS = Resource(
+    CreateAccountForm,
+    {'name': 'name', 'balance': 'balance', 'accnt_type': 'accnt_type',
+     'bank': 'bank'},
+    _create_accounts, account_json)
+ENTRIES = Resource(
+    CreateEntryForm,
+    {'descrip': 'descrip', 'date': 'date', 'tranact_type': 'tranact_type',
+     'amount': 'amount', 'account_id': 'assc_accnt',
+     'idempotency_key': 'idempotency_key'},
+    _create_entries, entry_json, account_fields=('assc_accnt',))
+TRANSFERS = Resource(
+    CreateTransferForm,
+    {'descrip': 'descrip', 'date': 'date', 'amount': 'amount',
+     'from_account_id': 'from_accnt', 'to_account_id': 'to_accnt',
+     'idempotency_key': 'idempotency_key'},
+    _create_transfers, transfer_json,
+    account_fields=('from_accnt', 'to_accnt'))
+
+
+def _account_arg():
+    """Returns the Account named by the ``account`` query argument, or
+    None if there is none.
+    """
+    if 'account' not in request.args:
+        return None
+    accnt_id = request.args.get('account', type=int)
+    if accnt_id is None:
+        raise ApiError(400, error='Invalid account id.')
+    return _get_account(accnt_id)
+
+
+def _get_account(accnt_id):
+    try:
+        return Account.get(Account.id == accnt_id)
+    except Account.DoesNotExist:
+        raise ApiError(404, error='No such account.')
+
+
+def _date_arg(name):
+    """Returns the date (YYYY-MM-DD) given as query argument ``name``,
+    or None if there is none.
+    """
+    if name not in request.args:
+        return None
+    try:
+        return datetime.datetime.strptime(request.args[name],
+                                          '%Y-%m-%d').date()
+    except ValueError:
+        raise ApiError(400, error='{} must be YYYY-MM-DD.'.format(name))
+
+
+def _limit_arg():
+    per_page = request.args.get('limit', PER_PAGE, type=int)
+    if not 0 < per_page <= MAX_PER_PAGE:
+        raise ApiError(400, error='limit must be between 1 and {}.'.format(
+            MAX_PER_PAGE))
+    return per_page
+
+
+def _page(queries, to_json):
+    per_page = _limit_arg()
+    try:
+        page = paginate(queries,
+                        after=request.args.get('after'),
+                        before=request.args.get('before'),
+                        per_page=per_page)
+    except ValueError as e:
+        raise ApiError(400, error=str(e))
+    return jsonify(items=[to_json(row) for row in page.items],
+                   next=page.next_cursor, prev=page.prev_cursor)
+
+
+@blueprint.route('/accounts', methods=('GET', 'POST'))
+def accounts():
+    if request.method == 'POST':
+        return ACCOUNTS.post()
+    return jsonify(items=[account_json(account) for account in
+                          Account.select().order_by(Account.id)])
+
+
+@blueprint.route('/accounts/<int:account_id>/balance')
+def account_balance(account_id):
+    """Returns an account's balance at the end of ``date`` (YYYY-MM-DD),
+    by default today.
+    """
+    account = _get_account(account_id)
+    date = _date_arg('date') or datetime.date.today()
+    return jsonify(account_id=account.id, date=date.isoformat(),
+                   balance=str(account.balance_as_of(date)))
+
+
+@blueprint.route('/entries', methods=('GET', 'POST'))
+def entries():
+    """Lists entries newest first, optionally of one ``account``, with
+    the same ``after`` / ``before`` cursors as the history pages.
+    """
+    if request.method == 'POST':
+        return ENTRIES.post()
+    account = _account_arg()
+    query = Entry.select()
+    if account is not None:
+        query = query.where(Entry.assc_accnt == account)
+    return _page([query], entry_json)
+
+
+@blueprint.route('/transfers', methods=('GET', 'POST'))
+def transfers():
+    """Lists transfers newest first, optionally those sent or received
+    by one ``account``.
+    """
+    if request.method == 'POST':
+        return TRANSFERS.post()
+    account = _account_arg()
+    if account is None:
+        queries = [Transfer.select()]
+    else:
+        queries = [Transfer.select().where(Transfer.from_accnt == account),
+                   Transfer.select().where(Transfer.to_accnt == account)]
+    return _page(queries, transfer_json)
+
+
+@blueprint.route('/search')
+def search_ledger():
+    """Finds the entries and transfers whose descriptions contain every
+    word of ``q`` (see search.match_expression()), best match first,
+    optionally of one ``account`` and between the ``start`` and ``end``
+    dates.
+    """
+    account = _account_arg()
+    try:
+        matches = search.search(
+            request.args.get('q', ''),
+            accnt_id=account.id if account is not None else None,
+            start=_date_arg('start'), end=_date_arg('end'),
+            limit=_limit_arg())
+    except search.SearchUnavailable as e:
+        raise ApiError(501, error=str(e))
+    items = []
+    for row, score in matches:
+        if isinstance(row, Entry):
+            item = dict(entry_json(row), type='entry')
+        else:
+            item = dict(transfer_json(row), type='transfer')
+        item['score'] = round(score, 3)
+        items.append(item)
+    return jsonify(items=items)
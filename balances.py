@@ -0,0 +1,55 @@
+"""Balance verification and rebuilding.
+
+Account.balance is only ever changed incrementally, by
+Entry.create_entry and Transfer.create_transfer. The functions here
+derive balances from the journal of postings they write instead, so
+that the stored balances can be audited and rebuilt. Balances on past
+dates are read from DailyBalance (see Account.balance_as_of()).
+"""
+from models import Account, DailyBalance, Posting
+
+PERIODS = ('day', 'month')
+
+# SQL sums over money columns are whole numbers of minor units.
+to_money = Account.balance.python_value
+
+
+def deltas_sql(where=''):
+    """Returns a query yielding one ``(accnt, date, delta)`` row per
+    posting to an account, read from the journal's ``(account, date)``
+    index. ``where`` adds conditions on ``account_id`` and ``date``.
+    """
+    return (
+        'SELECT account_id AS accnt, date, amount AS delta FROM {posting} '
+        'WHERE account_id IS NOT NULL{where}'
+    ).format(
+        posting=Posting._meta.db_table,
+        where=' AND ' + where if where else '',
+    )
+
+
+def rebuild_balances():
+    """Recomputes the daily balances (see DailyBalance) from the
+    journal, e.g. after rows were loaded without them. Returns the
+    number of rows written.
+    """
+    with DailyBalance._meta.database.transaction():
+        DailyBalance.rebuild()
+        return DailyBalance.select().count()
+
+
+def verify_balances():
+    """Recomputes every account's balance from its opening balance and
+    the ledger in a single aggregate query. Returns a list of
+    ``(account, expected_balance)`` pairs for the accounts whose stored
+    balance has drifted from the recomputed one.
+    """
+    cursor = Account._meta.database.execute_sql(
+        'SELECT a.id, a.opening_balance + COALESCE(SUM(d.delta), 0) '
+        'FROM {account} AS a LEFT OUTER JOIN ({deltas}) AS d '
+        'ON d.accnt = a.id GROUP BY a.id, a.opening_balance'.format(
+            account=Account._meta.db_table, deltas=deltas_sql()))
+    expected = {accnt_id: to_money(balance) for accnt_id, balance in cursor}
+    return [(account, expected[account.id])
+            for account in Account.select().order_by(Account.id)
+            if account.balance != expected[account.id]]
@@ -0,0 +1,164 @@
+"""Requests per second with concurrent readers and writers, comparing
+a plain SQLite database opened and closed for every request (the old
+setup) with the pooled, WAL-mode database in models.py, with and
+without the write-behind queue, and with reads served from a snapshot
+(see replicas.py).
+
+    python benchmarks/concurrency.py --readers 8 --writers 2 --seconds 5
+
+Each configuration gets a fresh database file, seeded with a few
+accounts and entries, and is served by a threaded development server.
+Readers fetch the index and an account's history; writers post entries.
+"""
+import argparse
+from http.client import HTTPConnection
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from peewee import SqliteDatabase
+from playhouse.test_utils import test_database
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flask_ledger  # noqa: E402
+from models import Account, Entry, MODELS, sqlite_database  # noqa: E402
+import write_queue  # noqa: E402
+
+# (name, database factory, app settings)
+CONFIGURATIONS = (
+    ('per-request connections', lambda path: SqliteDatabase(path), {}),
+    ('pooled WAL', sqlite_database, {}),
+    ('pooled WAL, write-behind', sqlite_database, {'WRITE_BEHIND': True}),
+    ('pooled WAL, snapshot reads', sqlite_database,
+     {'READ_REPLICA': 'snapshot'}),
+)
+
+
+def seed(accounts=5, entries=200):
+    for i in range(accounts):
+        Account.create_account(
+            name='Account #{}'.format(i),
+            balance=1000,
+            accnt_type='checking',
+            bank='Bank',
+        )
+    for account in Account.select():
+        Entry.insert_many([{
+            'descrip': 'Seed',
+            'date': '2017-11-12',
+            'tranact_type': 'credit',
+            'amount': 1,
+            'assc_accnt': account.id,
+        } for i in range(entries)]).execute()
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def worker(port, request, stop, counts, key):
+    """Sends ``request()`` (method, path, body) until ``stop`` is set.
+    Server errors, such as a locked database, are counted as errors.
+    """
+    connection = HTTPConnection('127.0.0.1', port)
+    done = failed = 0
+    while not stop.is_set():
+        method, path, body = request()
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        if response.status >= 500:
+            failed += 1
+        else:
+            done += 1
+    connection.close()
+    with counts['lock']:
+        counts[key] += done
+        counts['errors'] += failed
+
+
+def run(database, readers, writers, seconds):
+    """Returns the reads, writes and errors per second against
+    ``database``.
+    """
+    with test_database(database, MODELS):
+        seed()
+        Account.clear_cache()
+        account_ids = [a.id for a in Account.select(Account.id)]
+        database.close()
+
+        def read():
+            return 'GET', '/accounts/{}/entries'.format(account_ids[0]), None
+
+        def write():
+            return 'POST', '/create_entry', urlencode({
+                'descrip': 'Benchmark',
+                'date': '2017-11-13',
+                'tranact_type': 'credit',
+                'amount': '1.00',
+                'assc_accnt': account_ids[1],
+            })
+
+        server = make_server('127.0.0.1', 0, flask_ledger.app,
+                             threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        stop = threading.Event()
+        counts = {'lock': threading.Lock(), 'reads': 0, 'writes': 0,
+                  'errors': 0}
+        threads = (
+            [threading.Thread(target=worker, args=(
+                server.server_port, read, stop, counts, 'reads'))
+             for i in range(readers)] +
+            [threading.Thread(target=worker, args=(
+                server.server_port, write, stop, counts, 'writes'))
+             for i in range(writers)])
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        server.shutdown()
+        server.server_close()
+        write_queue.app_queue(flask_ledger.app).stop()
+        replica = flask_ledger.app.extensions.pop('replica', None)
+        if replica is not None:
+            replica.stop()
+    return dict((key, counts[key] / seconds)
+                for key in ('reads', 'writes', 'errors'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    flask_ledger.app.config['WTF_CSRF_ENABLED'] = False
+    defaults = dict(flask_ledger.app.config)
+    for name, make_database, settings in CONFIGURATIONS:
+        tmp_dir = tempfile.mkdtemp()
+        flask_ledger.app.config.update(settings)
+        try:
+            database = make_database(os.path.join(tmp_dir, 'bench.db'))
+            result = run(database, args.readers, args.writers,
+                         args.seconds)
+        finally:
+            flask_ledger.app.config.update(
+                (key, defaults[key]) for key in settings)
+            shutil.rmtree(tmp_dir)
+        print('{:<28} reads/sec {reads:>8.1f}  writes/sec {writes:>7.1f}  '
+              'errors/sec {errors:.1f}'.format(name, **result))
+
+
+if __name__ == '__main__':
+    main()
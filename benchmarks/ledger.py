@@ -0,0 +1,98 @@
+"""Synthetic ledgers for the benchmarks."""
+import contextlib
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from playhouse.test_utils import test_database
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from balances import verify_balances  # noqa: E402
+from importer import BATCH_SIZE  # noqa: E402
+from models import (Account, DailyBalance, Entry,  # noqa: E402
+                    LedgerVersion, MODELS, Posting, sqlite_database,
+                    Transfer)
+import search  # noqa: E402
+
+FIRST_DAY = datetime.date(2008, 1, 1)
+DAYS = 3650
+LAST_DAY = FIRST_DAY + datetime.timedelta(days=DAYS - 1)
+
+
+def generate(entries, accounts=20, seed=0):
+    """Fills the ledger with ``accounts`` accounts, ``entries`` entries
+    and a tenth as many transfers, spread in date order over ten years.
+    Account balances are then set to match the ledger, as if every row
+    had been posted through create_entry() or create_transfer(), and
+    the search index is built.
+    """
+    database = Entry._meta.database
+    rng = random.Random(seed)
+
+    def day(i, count):
+        return FIRST_DAY + datetime.timedelta(days=i * DAYS // count)
+
+    with database.transaction():
+        Account.insert_many([{
+            'name': 'Account #{}'.format(i),
+            'balance': 0,
+            'opening_balance': 0,
+            'accnt_type': 'checking',
+            'bank': 'Bank',
+        } for i in range(accounts)]).execute()
+
+        for start in range(0, entries, BATCH_SIZE):
+            Entry.insert_many([{
+                'descrip': 'Entry {}'.format(i),
+                'date': day(i, entries),
+                'tranact_type': rng.choice(('credit', 'debit')),
+                'amount': rng.randint(1, 100000) / 100,
+                'assc_accnt': rng.randint(1, accounts),
+            } for i in range(start, min(start + BATCH_SIZE, entries))],
+                validate_fields=False).execute()
+
+        transfers = entries // 10
+        for start in range(0, transfers, BATCH_SIZE):
+            rows = []
+            for i in range(start, min(start + BATCH_SIZE, transfers)):
+                from_id, to_id = rng.sample(range(1, accounts + 1), 2)
+                rows.append({
+                    'descrip': 'Transfer {}'.format(i),
+                    'date': day(i, transfers),
+                    'amount': rng.randint(1, 100000) / 100,
+                    'from_accnt': from_id,
+                    'to_accnt': to_id,
+                })
+            Transfer.insert_many(rows, validate_fields=False).execute()
+        Posting.backfill()
+        search.create_index(database)
+
+        for account, expected in verify_balances():
+            Account.update(balance=expected).where(
+                Account.id == account.id).execute()
+        DailyBalance.rebuild()
+        LedgerVersion.bump()
+    Account.clear_cache()
+
+
+@contextlib.contextmanager
+def synthetic_ledger(entries, accounts=20):
+    """Binds the models to a new, pooled SQLite file holding a generated
+    ledger for the duration of the block, and yields its database.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    database = sqlite_database(os.path.join(tmp_dir, 'ledger.db'))
+    try:
+        with test_database(database, MODELS):
+            generate(entries, accounts)
+            yield database
+    finally:
+        Account.clear_cache()
+        if not database.is_closed():
+            database.close()
+        database.close_all()
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,73 @@
+"""Response times of the report views on a large synthetic ledger.
+
+    python benchmarks/reports.py --entries 1000000 --runs 20
+
+Entries and transfers are spread over ten years and --accounts
+accounts, with one transfer for every ten entries. Every report is
+then requested --runs times through the test client. Any report whose
+median is over 100ms is marked SLOW.
+"""
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.ledger import (FIRST_DAY, LAST_DAY,  # noqa: E402
+                               synthetic_ledger)
+import flask_ledger  # noqa: E402
+
+TARGET_MS = 100
+
+
+def time_requests(client, url, runs):
+    timings = []
+    for i in range(runs):
+        started = time.perf_counter()
+        rv = client.get(url)
+        timings.append((time.perf_counter() - started) * 1000)
+        assert rv.status_code == 200, (url, rv.status_code)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--accounts', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    last_day = LAST_DAY
+    year = 'start={}&end={}'.format(
+        (last_day - datetime.timedelta(days=335)).replace(day=1), last_day)
+    urls = [
+        '/reports/cash_flow?' + year,
+        '/reports/cash_flow?account=1&' + year,
+        '/reports/cash_flow?account=1&start={}&end={}'.format(
+            FIRST_DAY, last_day),
+        '/reports/transfer_flows?' + year,
+        '/reports/transfer_flows?start={}&end={}'.format(
+            FIRST_DAY, last_day),
+        '/reports/running_balance/1?' + year,
+        '/reports/running_balance/1?period=month&start={}&end={}'.format(
+            FIRST_DAY, last_day),
+    ]
+
+    started = time.time()
+    with synthetic_ledger(args.entries, args.accounts):
+        print('Generated {} entries in {:.0f}s'.format(
+            args.entries, time.time() - started))
+
+        client = flask_ledger.app.test_client()
+        for url in urls:
+            timings = sorted(time_requests(client, url, args.runs))
+            median = statistics.median(timings)
+            print('{:>8.1f}ms median {:>8.1f}ms max  {}{}'.format(
+                median, timings[-1], url,
+                '  SLOW' if median > TARGET_MS else ''))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""Throughput and latency of the ledger's write and read paths.
+
+    python benchmarks/suite.py --sizes 10000 100000 1000000
+    python benchmarks/suite.py --compare benchmarks/results/abc1234.json
+
+For every ledger size a synthetic ledger is generated (see ledger.py)
+and each case below is run against it, through the model layer or the
+Flask test client. Results are written as JSON, by default to
+benchmarks/results/<commit>.json, so that two commits can be compared
+with --compare: a case whose p50 latency or throughput is more than
+--threshold percent worse is reported, and the exit status is 1.
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from balances import rebuild_balances, verify_balances  # noqa: E402
+from benchmarks.ledger import LAST_DAY, synthetic_ledger  # noqa: E402
+import flask_ledger  # noqa: E402
+from importer import import_statement  # noqa: E402
+from models import Account, Entry, Transfer  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'results')
+SIZES = (10000, 100000, 1000000)
+
+
+def percentile(timings, percent):
+    """Returns the nearest-rank percentile of sorted ``timings``."""
+    rank = max(int(round(percent / 100.0 * len(timings))), 1)
+    return timings[rank - 1]
+
+
+class Case(object):
+    """A benchmark case. ``run(context, i)`` performs one operation and
+    returns the number of rows it handled; cases run ``repeat`` times
+    and report throughput in ``unit``.
+    """
+    def __init__(self, name, run, repeat, unit='ops'):
+        self.name = name
+        self.run = run
+        self.repeat = repeat
+        self.unit = unit
+
+    def measure(self, context):
+        timings = []
+        rows = 0
+        for i in range(self.repeat):
+            started = time.perf_counter()
+            rows += self.run(context, i)
+            timings.append(time.perf_counter() - started)
+        total = sum(timings)
+        timings.sort()
+        return {
+            'case': self.name,
+            'ops': self.repeat,
+            'unit': '{}/s'.format(self.unit),
+            'throughput': rows / total if total else 0.0,
+            'p50_ms': percentile(timings, 50) * 1000,
+            'p99_ms': percentile(timings, 99) * 1000,
+            'mean_ms': total / self.repeat * 1000,
+        }
+
+
+def model_create_entry(context, i):
+    Entry.create_entry(descrip='Benchmark', date=LAST_DAY,
+                       tranact_type='credit', amount='12.34',
+                       assc_accnt=context['account_1'])
+    return 1
+
+
+def model_create_transfer(context, i):
+    Transfer.create_transfer(descrip='Benchmark', date=LAST_DAY,
+                             amount='12.34',
+                             from_accnt=context['account_1'],
+                             to_accnt=context['account_2'])
+    return 1
+
+
+def _post(context, url, data):
+    rv = context['client'].post(url, data=data)
+    assert rv.status_code == 302, (url, rv.status_code)
+    return 1
+
+
+def view_create_entry(context, i):
+    return _post(context, '/create_entry', {
+        'descrip': 'Benchmark',
+        'date': LAST_DAY.isoformat(),
+        'tranact_type': 'debit',
+        'amount': '12.34',
+        'assc_accnt': context['account_1'].id,
+    })
+
+
+def view_create_transfer(context, i):
+    return _post(context, '/create_transfer', {
+        'descrip': 'Benchmark',
+        'date': LAST_DAY.isoformat(),
+        'amount': '12.34',
+        'from_accnt': context['account_2'].id,
+        'to_accnt': context['account_1'].id,
+    })
+
+
+def api_create_entries(rows):
+    def run(context, i):
+        body = json.dumps([{
+            'descrip': 'Benchmark {}'.format(n),
+            'date': LAST_DAY.isoformat(),
+            'tranact_type': 'credit',
+            'amount': '12.34',
+            'account_id': n % 20 + 1,
+        } for n in range(rows)])
+        rv = context['client'].post('/api/v1/entries', data=body,
+                                    content_type='application/json')
+        assert rv.status_code == 201, rv.status_code
+        return rows
+    return run
+
+
+def _get(context, url):
+    rv = context['client'].get(url)
+    assert rv.status_code == 200, (url, rv.status_code)
+    return rv
+
+
+def view_get(url):
+    def run(context, i):
+        _get(context, url)
+        return 1
+    return run
+
+
+def view_revalidate(url):
+    """A client that already has the page, and sends back its ETag."""
+    def run(context, i):
+        etag = _get(context, url).headers['ETag']
+        rv = context['client'].get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 304, (url, rv.status_code)
+        return 1
+    return run
+
+
+def bulk_import(rows):
+    def run(context, i):
+        lines = io.StringIO('date,description,amount,account\n' + ''.join(
+            '{},Imported {},{}.{:02d},Account #{}\n'.format(
+                LAST_DAY, n, n % 500 - 250, n % 100, n % 20)
+            for n in range(rows)))
+        return import_statement(lines).rows
+    return run
+
+
+def bulk_export(context, i):
+    rv = _get(context, '/export/entries.csv')
+    return rv.get_data().count(b'\n') - 1
+
+
+def bulk_verify(context, i):
+    assert verify_balances() == []
+    return Entry.select().count() + Transfer.select().count()
+
+
+def bulk_rebuild_balances(context, i):
+    return rebuild_balances()
+
+
+CASES = [
+    Case('model.create_entry', model_create_entry, 500),
+    Case('model.create_transfer', model_create_transfer, 500),
+    Case('view.create_entry', view_create_entry, 300, 'rows'),
+    Case('view.create_transfer', view_create_transfer, 300),
+    Case('api.create_entries_batch', api_create_entries(500), 10, 'rows'),
+    Case('view.index', view_get('/'), 300),
+    Case('view.index_revalidate', view_revalidate('/'), 300),
+    Case('view.account_entries', view_get('/accounts/1/entries'), 300),
+    Case('api.balance_as_of', view_get(
+        '/api/v1/accounts/1/balance?date=2012-06-30'), 300),
+    Case('api.search', view_get('/api/v1/search?q=transfer+12'), 300),
+    Case('view.cash_flow_report', view_get(
+        '/reports/cash_flow?end={}'.format(LAST_DAY)), 20),
+    Case('bulk.import_csv', bulk_import(10000), 3, 'rows'),
+    Case('bulk.export_csv', bulk_export, 3, 'rows'),
+    Case('bulk.verify_balances', bulk_verify, 3, 'rows'),
+    Case('bulk.rebuild_balances', bulk_rebuild_balances, 1, 'rows'),
+]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(RESULTS_DIR),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_suite(sizes, cases):
+    results = []
+    flask_ledger.app.config['WTF_CSRF_ENABLED'] = False
+    for size in sizes:
+        started = time.time()
+        with synthetic_ledger(size):
+            print('{} entries, generated in {:.0f}s'.format(
+                size, time.time() - started))
+            context = {
+                'client': flask_ledger.app.test_client(),
+                'account_1': Account.get(Account.id == 1),
+                'account_2': Account.get(Account.id == 2),
+            }
+            for case in cases:
+                result = case.measure(context)
+                result['size'] = size
+                results.append(result)
+                print('  {case:<26} {throughput:>10.1f} {unit:<12} '
+                      'p50 {p50_ms:>8.2f}ms  p99 {p99_ms:>8.2f}ms'.format(
+                          **result))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints the change of every case against ``baseline`` and returns
+    the number of regressions worse than ``threshold`` percent.
+    """
+    old = dict(((result['size'], result['case']), result)
+               for result in baseline['results'])
+    regressions = 0
+    print('Compared with {}:'.format(baseline['meta']['commit']))
+    for result in results:
+        before = old.get((result['size'], result['case']))
+        if before is None:
+            continue
+        p50 = (result['p50_ms'] / before['p50_ms'] - 1) * 100
+        throughput = (result['throughput'] / before['throughput'] - 1) * 100
+        regressed = p50 > threshold or -throughput > threshold
+        regressions += regressed
+        print('  {:>8} {:<26} p50 {:+7.1f}%  throughput {:+7.1f}%{}'.format(
+            result['size'], result['case'], p50, throughput,
+            '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--cases', nargs='+', metavar='CASE',
+                        help='Only run the cases whose names start with '
+                             'one of these prefixes.')
+    parser.add_argument('--output', help='Where to write the results.')
+    parser.add_argument('--compare', metavar='RESULTS',
+                        help='Results of an earlier run to compare with.')
+    parser.add_argument('--threshold', type=float, default=10.0)
+    args = parser.parse_args()
+
+    cases = [case for case in CASES
+             if not args.cases or case.name.startswith(tuple(args.cases))]
+    commit = git_commit()
+    document = {
+        'meta': {
+            'commit': commit,
+            'date': datetime.datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'results': run_suite(args.sizes, cases),
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, commit + '.json')
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+    print('Results written to {}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(document['results'], baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
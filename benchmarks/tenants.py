@@ -0,0 +1,99 @@
+"""Entries written per second by concurrent writers, all to one SQLite
+file, compared with the same writers spread over tenants that each
+have a file of their own (see tenants.py).
+
+    python benchmarks/tenants.py --writers 16 --tenants 1 4 16
+    python benchmarks/tenants.py --synchronous full
+
+Writers call the model layer directly, bound to their tenant's
+database, one entry per transaction. Writer ``i`` writes to tenant
+``i % tenants``.
+"""
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import Account, bound_database, Entry, PRAGMAS  # noqa: E402
+import tenants  # noqa: E402
+
+
+def run(path, tenant_count, writers, seconds, pragmas):
+    """Returns the entries written per second by ``writers`` threads
+    spread over ``tenant_count`` tenants.
+    """
+    databases = tenants.TenantDatabases(path, max_open=tenant_count,
+                                        pragmas=pragmas)
+    names = ['tenant{}'.format(i) for i in range(tenant_count)]
+    for name in names:
+        with bound_database(databases.get(name)):
+            Account.create_account(name='Benchmark', balance=0,
+                                   accnt_type='checking', bank='Bank')
+    stop = threading.Event()
+    counts = []
+
+    def worker(name):
+        database = databases.get(name)
+        done = 0
+        with bound_database(database):
+            account = Account.select().get()
+            try:
+                while not stop.is_set():
+                    Entry.create_entry(
+                        descrip='Benchmark', date=datetime.date(2017, 11, 13),
+                        tranact_type='credit', amount='1.00',
+                        assc_accnt=account)
+                    done += 1
+            finally:
+                if not database.is_closed():
+                    database.close()
+        counts.append(done)
+
+    threads = [threading.Thread(target=worker,
+                                args=(names[i % tenant_count],))
+               for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    written = 0
+    for name in names:
+        with bound_database(databases.get(name)):
+            written += Entry.select().count()
+    assert written == sum(counts)
+    databases.close_all()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=16)
+    parser.add_argument('--tenants', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--synchronous', default='normal',
+                        choices=('off', 'normal', 'full'))
+    args = parser.parse_args()
+
+    pragmas = tuple((name, args.synchronous if name == 'synchronous'
+                     else value) for name, value in PRAGMAS)
+    for tenant_count in args.tenants:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            rate = run(os.path.join(tmp_dir, '{tenant}.db'), tenant_count,
+                       args.writers, args.seconds, pragmas)
+        finally:
+            shutil.rmtree(tmp_dir)
+        print('{:>3} tenant(s)  entries/sec {:>9.1f}'.format(
+            tenant_count, rate))
+
+
+if __name__ == '__main__':
+    main()
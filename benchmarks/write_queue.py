@@ -0,0 +1,106 @@
+"""Entries written per second by concurrent writers, each committing
+its own transaction, compared with the same writers going through the
+write-behind queue in write_queue.py.
+
+    python benchmarks/write_queue.py --writers 16 --seconds 5
+    python benchmarks/write_queue.py --synchronous full
+
+Writers call the model layer directly, so the figures show the cost of
+the write path rather than of HTTP handling. --synchronous sets
+SQLite's synchronous pragma: with FULL every commit waits for an fsync,
+which is where group commit helps the most.
+"""
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from playhouse.test_utils import test_database
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import (Account, Entry, MODELS, PRAGMAS,  # noqa: E402
+                    sqlite_database)
+from write_queue import WriteQueue  # noqa: E402
+
+
+def direct(account):
+    return lambda: Entry.create_entry(
+        descrip='Benchmark', date=datetime.date(2017, 11, 13),
+        tranact_type='credit', amount='1.00', assc_accnt=account)
+
+
+def queued(account, write_queue):
+    return lambda: write_queue.submit(
+        Entry, descrip='Benchmark', date=datetime.date(2017, 11, 13),
+        tranact_type='credit', amount='1.00', assc_accnt=account).result()
+
+
+def run(database, writers, seconds, use_queue, max_batch, max_latency):
+    """Returns the entries written per second, with ``writers``
+    threads writing one entry at a time.
+    """
+    with test_database(database, MODELS):
+        Account.create_account(name='Benchmark', balance=0,
+                               accnt_type='checking', bank='Bank')
+        account = Account.select().get()
+        write_queue = WriteQueue(max_batch, max_latency)
+        write = queued(account, write_queue) if use_queue else direct(account)
+        stop = threading.Event()
+        counts = []
+
+        def worker():
+            done = 0
+            try:
+                while not stop.is_set():
+                    write()
+                    done += 1
+            finally:
+                if not database.is_closed():
+                    database.close()
+            counts.append(done)
+
+        threads = [threading.Thread(target=worker) for i in range(writers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        write_queue.stop()
+        assert Entry.select().count() == sum(counts)
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--synchronous', default='normal',
+                        choices=('off', 'normal', 'full'))
+    parser.add_argument('--max-batch', type=int, default=500)
+    parser.add_argument('--max-latency', type=float, default=0.002)
+    args = parser.parse_args()
+
+    pragmas = tuple((name, args.synchronous if name == 'synchronous'
+                     else value) for name, value in PRAGMAS)
+    for name, use_queue in (('transaction per entry', False),
+                            ('write-behind queue', True)):
+        tmp_dir = tempfile.mkdtemp()
+        database = sqlite_database(os.path.join(tmp_dir, 'bench.db'),
+                                   pragmas=pragmas)
+        try:
+            rate = run(database, args.writers, args.seconds, use_queue,
+                       args.max_batch, args.max_latency)
+        finally:
+            database.close_all()
+            shutil.rmtree(tmp_dir)
+        print('{:<22} entries/sec {:>9.1f}'.format(name, rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Streaming CSV and NDJSON export of entries and transfers.
+
+Rows are read from the database cursor as they are written out, rather
+than collected first, so memory use does not depend on the size of the
+ledger. Output is yielded in chunks of CHUNK_ROWS rows.
+"""
+import csv
+import io
+import json
+
+from models import Account, Entry, Transfer
+
+try:
+    from playhouse.postgres_ext import (PostgresqlExtDatabase,
+                                        ServerSideSelectQuery)
+except ImportError:
+    PostgresqlExtDatabase = None
+
+CHUNK_ROWS = 500
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def _iterate(results):
+    while True:
+        try:
+            yield results.iterate()
+        except StopIteration:
+            return
+
+
+def iterate(query):
+    """Yields the rows of ``query`` one at a time, without keeping them
+    in the query's result cache.
+
+    On PostgreSQL (the ``postgresext`` schemes) the rows are read
+    through a server-side cursor, which needs a transaction, instead of
+    the driver fetching the whole result set up front.
+    """
+    database = query.database
+    if PostgresqlExtDatabase and isinstance(database, PostgresqlExtDatabase):
+        with database.transaction():
+            query = ServerSideSelectQuery.clone_from_query(query)
+            for row in _iterate(query.execute()):
+                yield row
+    else:
+        for row in _iterate(query.execute()):
+            yield row
+
+
+def _filter_dates(query, model, start, end):
+    if start is not None:
+        query = query.where(model.date >= start)
+    if end is not None:
+        query = query.where(model.date <= end)
+    return query
+
+
+def entries(start=None, end=None, accnt_id=None):
+    """Returns the column names and rows of the entries dated between
+    ``start`` and ``end`` (inclusive, either may be None), optionally
+    only those of one account, in date order.
+    """
+    columns = ('id', 'date', 'descrip', 'tranact_type', 'amount',
+               'account_id', 'account')
+    query = (Entry
+             .select(Entry.id, Entry.date, Entry.descrip,
+                     Entry.tranact_type, Entry.amount, Entry.assc_accnt,
+                     Account.name)
+             .join(Account)
+             .order_by(Entry.date, Entry.id))
+    if accnt_id is not None:
+        query = query.where(Entry.assc_accnt == accnt_id)
+    query = _filter_dates(query, Entry, start, end)
+    return columns, iterate(query.tuples())
+
+
+def transfers(start=None, end=None, accnt_id=None):
+    """Like entries(), for transfers sent or received by the account."""
+    columns = ('id', 'date', 'descrip', 'amount', 'from_accnt_id',
+               'from_accnt', 'to_accnt_id', 'to_accnt')
+    from_accnt = Account.alias()
+    to_accnt = Account.alias()
+    query = (Transfer
+             .select(Transfer.id, Transfer.date, Transfer.descrip,
+                     Transfer.amount, Transfer.from_accnt, from_accnt.name,
+                     Transfer.to_accnt, to_accnt.name)
+             .join(from_accnt, on=(Transfer.from_accnt == from_accnt.id))
+             .switch(Transfer)
+             .join(to_accnt, on=(Transfer.to_accnt == to_accnt.id))
+             .order_by(Transfer.date, Transfer.id))
+    if accnt_id is not None:
+        query = query.where((Transfer.from_accnt == accnt_id) |
+                            (Transfer.to_accnt == accnt_id))
+    query = _filter_dates(query, Transfer, start, end)
+    return columns, iterate(query.tuples())
+
+
+EXPORTS = {
+    'entries': entries,
+    'transfers': transfers,
+}
+
+
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def to_csv(columns, rows):
+    """Yields a CSV document, header row first."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for chunk in _chunks(rows):
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def to_ndjson(columns, rows):
+    """Yields one JSON object per line. Dates and amounts are strings."""
+    for chunk in _chunks(rows):
+        yield ''.join(
+            json.dumps(dict(zip(columns, row)), default=str) + '\n'
+            for row in chunk)
+
+
+SERIALIZERS = {
+    'csv': to_csv,
+    'ndjson': to_ndjson,
+}
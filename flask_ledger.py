@@ -1,12 +1,31 @@
-from flask import (Flask, g, render_template,
-                   flash, redirect, url_for,
+import datetime
+import io
+import time
+import uuid
+
+import click
+from flask import (Flask, g, jsonify, render_template,
+                   flash, redirect, request, Response,
+                   stream_with_context, url_for,
                    abort)
 
-from forms import CreateAccountForm, CreateEntryForm, CreateTransferForm
-from models import (Account, DATABASE, Entry, initialize,
-                    Transfer, )
+import api
+from balances import PERIODS, rebuild_balances, verify_balances
+import export
+from forms import (CreateAccountForm, CreateEntryForm, CreateTransferForm,
+                   ImportStatementForm)
+import importer
+import instrumentation
+import metrics
+from models import (Account, bind_database, Entry, IdempotencyKeyReused,
+                    initialize, Transfer, )
 
-from peewee import OperationalError
+from page_cache import cached_page
+from pagination import paginate
+import replicas
+import reports
+import tenants
+import write_queue
 
 DEBUG = True
 PORT = 8000
@@ -14,23 +33,117 @@ HOST = '0.0.0.0'
 
 app = Flask(__name__)
 app.secret_key = "aasdfasdf;aosihasgo*(&^Uhkewjd7efI&%$iygkjbsd"
+# Statements slower than this are logged, with their parameters, by
+# the flask_ledger.sql logger. None turns the log off.
+app.config['SLOW_QUERY_MS'] = 100
+# With WRITE_BEHIND on, entries and transfers posted one at a time are
+# group-committed by a writer thread (see write_queue.py), in batches
+# of up to WRITE_QUEUE_MAX_BATCH rows, waiting up to
+# WRITE_QUEUE_MAX_LATENCY seconds to fill one. A request gives up on
+# its write after WRITE_QUEUE_TIMEOUT seconds.
+app.config['WRITE_BEHIND'] = False
+app.config['WRITE_QUEUE_MAX_BATCH'] = 500
+app.config['WRITE_QUEUE_MAX_LATENCY'] = 0.002
+app.config['WRITE_QUEUE_TIMEOUT'] = 10
+# With TENANT_DATABASE set, e.g. to 'tenants/{tenant}.db', each tenant
+# has a ledger in a SQLite file of its own, and every request is for
+# the tenant named in its TENANT_HEADER header (see tenants.py). At
+# most TENANT_MAX_OPEN tenants' databases are kept open.
+app.config['TENANT_DATABASE'] = None
+app.config['TENANT_HEADER'] = 'X-Ledger-Tenant'
+app.config['TENANT_MAX_OPEN'] = 64
+# With READ_REPLICA set, GET and HEAD requests read from a replica (see
+# replicas.py): 'snapshot' for a copy of the SQLite file refreshed
+# every READ_REPLICA_REFRESH seconds, or the URL of a database that
+# replicates this one. Sessions read their own writes. Tenants' ledgers
+# have no replicas.
+app.config['READ_REPLICA'] = None
+app.config['READ_REPLICA_REFRESH'] = 1.0
+app.register_blueprint(api.blueprint)
+
+
+# Served the same whichever tenant asks, or none.
+UNTENANTED_ENDPOINTS = ('static', 'metrics_view')
 
 
 @app.before_request
 def before_request():
-    """Connect to the database before each request."""
-    g.db = DATABASE
-    try:
+    """Binds the models to the tenant's database, if there are tenants,
+    or else to the read replica if the request can be served from it,
+    and takes a connection from the pool before each request, unless
+    this thread already has one open.
+    """
+    g.request_started = time.perf_counter()
+    tenant_databases = tenants.app_tenants(app)
+    if tenant_databases is None:
+        database = replicas.read_database(app)
+        if database is not None:
+            g.previous_db = bind_database(database)
+    elif request.endpoint not in UNTENANTED_ENDPOINTS:
+        try:
+            database = tenant_databases.get(
+                request.headers.get(app.config['TENANT_HEADER']))
+        except ValueError:
+            abort(400)
+        g.previous_db = bind_database(database)
+    g.db = Account._meta.database
+    g.db_opened = g.db.is_closed()
+    if g.db_opened:
+        connect_started = time.perf_counter()
         g.db.connect()
-    except OperationalError:
-        pass
+        metrics.DB_CONNECT_SECONDS.observe(
+            time.perf_counter() - connect_started)
+    instrumentation.start_request(g.db)
 
 
 @app.after_request
 def after_request(response):
-    """Close the database connection after each request."""
-    g.db.close()
-    return response
+    """Remembers the session's writes, for reads from the replica, and
+    reports the request's SQL statements in a Server-Timing header.
+    """
+    if tenants.app_tenants(app) is None:
+        replicas.remember_writes(app)
+    return instrumentation.add_server_timing(response)
+
+
+@app.teardown_request
+def teardown_request(exc):
+    """Logs the request's SQL statements, records its metrics and
+    returns its connection to the pool. Streamed responses keep the
+    request open until they have been sent.
+    """
+    stats = instrumentation.finish_request()
+    if stats is not None:
+        endpoint = request.endpoint or 'none'
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - g.request_started, endpoint=endpoint)
+        metrics.REQUEST_DB_SECONDS.observe(stats.seconds, endpoint=endpoint)
+    if g.get('db_opened'):
+        g.db.close()
+    if 'previous_db' in g:
+        bind_database(g.previous_db)
+
+
+def account_choices(form, *fields):
+    """Returns the cached account choices for a form's account fields,
+    making sure any account id submitted with the form is included.
+    """
+    submitted = [field.data for field in fields] if form.is_submitted() else []
+    return Account.cached_choices(*submitted)
+
+
+# Flashed when a form is submitted again with other values.
+REUSED_KEY_MESSAGE = ('This form was already used for another {}. '
+                      'Submit it again to create a new one.')
+
+
+def new_idempotency_key(form, replace=False):
+    """Gives a form that is about to be shown for the first time, or
+    whose key was used for other values (``replace``), a new
+    idempotency key. A resubmitted form keeps the key it was sent with.
+    """
+    if replace or not form.is_submitted():
+        form.idempotency_key.data = uuid.uuid4().hex
 
 
 @app.route('/create_account', methods=('GET', 'POST'))
@@ -57,32 +170,34 @@ def create_account():
 @app.route('/create_entry', methods=('GET', 'POST'))
 def create_entry():
     form = CreateEntryForm()
-    form.assc_accnt.choices = [(str(account.id), account.name)
-                               for account in Account.select()]
+    form.assc_accnt.choices = account_choices(form, form.assc_accnt)
+    new_idempotency_key(form)
 
     if form.assc_accnt.choices == []:
         flash('Need to create an Account first', category='failure')
         return redirect(url_for('index'))
 
     if form.validate_on_submit():
-        assc_accnt = Account.select().where(
-            Account.id == form.assc_accnt.data).get()
+        assc_accnt = Account.cached(form.assc_accnt.data)
         try:
-            Entry.create_entry(
+            write_queue.write(
+                Entry,
                 descrip=form.descrip.data,
                 date=form.date.data,
                 tranact_type=form.tranact_type.data,
                 amount=form.amount.data,
                 assc_accnt=assc_accnt,
+                idempotency_key=form.idempotency_key.data or None,
             )
+        except IdempotencyKeyReused:
+            flash(REUSED_KEY_MESSAGE.format('entry'), category='failure')
+            new_idempotency_key(form, replace=True)
+            return render_template('create_entry.html', form=form), 422
         except Exception as e:
             flash('An error occured in creating your entry',
                   category='failure')
             flash(e, category='failure')
         else:
-            lst_entry = Entry.select().count()
-            entry = Entry.select().where(Entry.id == lst_entry).get()
-            entry.mk_accnt_chgs()
             flash('Entry Created', category='success')
             return redirect(url_for('index'))
     return render_template('create_entry.html', form=form)
@@ -91,20 +206,18 @@ def create_entry():
 @app.route('/create_transfer', methods=('GET', 'POST'))
 def create_transfer():
     form = CreateTransferForm()
-    choices = [(str(account.id), account.name)
-               for account in Account.select()]
+    choices = account_choices(form, form.from_accnt, form.to_accnt)
     form.from_accnt.choices = choices
     form.to_accnt.choices = choices
+    new_idempotency_key(form)
 
     if len(form.from_accnt.choices) < 2:
         flash('Need to create two Accounts first', category='failure')
         return redirect(url_for('index'))
 
     if form.validate_on_submit():
-        from_accnt = Account.select().where(
-            Account.id == form.from_accnt.data).get()
-        to_accnt = Account.select().where(
-            Account.id == form.to_accnt.data).get()
+        from_accnt = Account.cached(form.from_accnt.data)
+        to_accnt = Account.cached(form.to_accnt.data)
 
         if form.from_accnt.data == form.from_accnt.data:
             flash(
@@ -114,31 +227,269 @@ def create_transfer():
             render_template('create_transfer.html', form=form)
 
         try:
-            Transfer.create_transfer(
+            write_queue.write(
+                Transfer,
                 descrip=form.descrip.data,
                 date=form.date.data,
                 amount=form.amount.data,
                 from_accnt=from_accnt,
                 to_accnt=to_accnt,
+                idempotency_key=form.idempotency_key.data or None,
             )
+        except IdempotencyKeyReused:
+            flash(REUSED_KEY_MESSAGE.format('transfer'), category='failure')
+            new_idempotency_key(form, replace=True)
+            return render_template('create_transfer.html', form=form), 422
         except Exception as e:
             flash(e, category='failure')
         else:
-            lst_transfer = Transfer.select().count()
-            transfer = Transfer.select().where(
-                Transfer.id == lst_transfer).get()
-            transfer.mk_transfer()
             flash('Transfer Successful', category='success')
             return redirect(url_for('index'))
     return render_template('create_transfer.html', form=form)
 
 
+@app.route('/import_statement', methods=('GET', 'POST'))
+def import_statement():
+    form = ImportStatementForm()
+    form.assc_accnt.choices = account_choices(form, form.assc_accnt)
+
+    if form.assc_accnt.choices == []:
+        flash('Need to create an Account first', category='failure')
+        return redirect(url_for('index'))
+
+    if form.validate_on_submit():
+        assc_accnt = Account.cached(form.assc_accnt.data)
+        lines = io.TextIOWrapper(form.statement.data.stream,
+                                 encoding='utf-8', newline='')
+        try:
+            result = importer.import_statement(
+                lines,
+                statement_format=form.statement_format.data,
+                account=assc_accnt,
+            )
+        except Exception as e:
+            flash('An error occured in importing your statement',
+                  category='failure')
+            flash(e, category='failure')
+        else:
+            flash(str(result), category='success')
+            return redirect(url_for('index'))
+    return render_template('import_statement.html', form=form)
+
+
+def ledger_filters():
+    """Returns the ``start`` / ``end`` dates (YYYY-MM-DD) and the
+    ``account`` id given in the query string, each None if it is
+    missing. Aborts with 400 if any of them is invalid.
+    """
+    try:
+        start, end = [
+            datetime.datetime.strptime(request.args[arg], '%Y-%m-%d').date()
+            if arg in request.args else None
+            for arg in ('start', 'end')
+        ]
+        accnt_id = request.args.get('account', type=int)
+        if 'account' in request.args and accnt_id is None:
+            raise ValueError('Invalid account id')
+    except ValueError:
+        abort(400)
+    return start, end, accnt_id
+
+
+@app.route('/export/<kind>.<fmt>')
+def export_ledger(kind, fmt):
+    """Streams every entry or transfer as CSV or NDJSON, optionally
+    limited to the ``start`` / ``end`` dates (YYYY-MM-DD) and the
+    ``account`` id given in the query string.
+    """
+    if kind not in export.EXPORTS or fmt not in export.SERIALIZERS:
+        abort(404)
+    start, end, accnt_id = ledger_filters()
+    columns, rows = export.EXPORTS[kind](start, end, accnt_id)
+    return Response(
+        stream_with_context(export.SERIALIZERS[fmt](columns, rows)),
+        mimetype=export.MIMETYPES[fmt],
+        headers={'Content-Disposition':
+                 'attachment; filename={}.{}'.format(kind, fmt)},
+    )
+
+
+def report_range():
+    """Like ledger_filters(), but the dates default to the
+    reports.DEFAULT_MONTHS months up to today.
+    """
+    start, end, accnt_id = ledger_filters()
+    end = end or datetime.date.today()
+    start = start or reports.default_start(end)
+    if start > end:
+        abort(400)
+    return start, end, accnt_id
+
+
+def report_response(start, end, rows):
+    return jsonify(start=start.isoformat(), end=end.isoformat(), rows=rows)
+
+
+@app.route('/reports/cash_flow')
+def cash_flow_report():
+    """Credits, debits and transfers per account and month, as JSON."""
+    start, end, accnt_id = report_range()
+    return report_response(start, end,
+                           reports.cash_flow(start, end, accnt_id))
+
+
+@app.route('/reports/transfer_flows')
+def transfer_flows_report():
+    """Net transfers between each pair of accounts, as JSON."""
+    start, end, accnt_id = report_range()
+    return report_response(start, end,
+                           reports.transfer_flows(start, end, accnt_id))
+
+
+@app.route('/reports/running_balance/<int:account_id>')
+def running_balance_report(account_id):
+    """An account's balance after each day (or ``period=month``) with
+    activity, as JSON.
+    """
+    account = get_account_or_404(account_id)
+    start, end = report_range()[:2]
+    period = request.args.get('period', 'day')
+    if period not in PERIODS:
+        abort(400)
+    return report_response(start, end, reports.running_balance(
+        account, start, end, period))
+
+
+LEDGER_ROWS = metrics.Gauge(
+    'ledger_rows', 'Rows in each ledger table.', ('table',),
+    collect=lambda: [({'table': model._meta.db_table}, model.select().count())
+                     for model in (Account, Entry, Transfer)])
+
+
+@app.route('/metrics')
+def metrics_view():
+    """Every metric, in the Prometheus text format."""
+    return Response(metrics.exposition(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/')
 def index():
-    accounts = Account.select()
-    return render_template('index.html', accounts=accounts)
+    # A single query: the history of each account is paginated on its
+    # own pages.
+    return cached_page('index', lambda: render_template(
+        'index.html', accounts=Account.select()))
+
+
+def get_account_or_404(account_id):
+    try:
+        return Account.get(Account.id == account_id)
+    except Account.DoesNotExist:
+        abort(404)
+
+
+def get_page(queries):
+    """Paginates ``queries`` using the request's ``after`` / ``before``
+    cursors.
+    """
+    try:
+        return paginate(queries,
+                        after=request.args.get('after'),
+                        before=request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+
+def history_key(account_id):
+    return (request.endpoint, account_id,
+            request.args.get('after'), request.args.get('before'))
+
+
+@app.route('/accounts/<int:account_id>/entries')
+def account_entries(account_id):
+    return cached_page(history_key(account_id),
+                       lambda: render_account_entries(account_id))
+
+
+def render_account_entries(account_id):
+    account = get_account_or_404(account_id)
+    page = get_page([Entry.select().where(Entry.assc_accnt == account)])
+    return render_template('account_entries.html',
+                           account=account, page=page)
+
+
+@app.route('/accounts/<int:account_id>/transfers')
+def account_transfers(account_id):
+    return cached_page(history_key(account_id),
+                       lambda: render_account_transfers(account_id))
+
+
+def render_account_transfers(account_id):
+    account = get_account_or_404(account_id)
+    # Sent and received transfers are read from their own indexes, with
+    # the name of the account on the other side joined in.
+    other = Account.alias()
+    sent = (Transfer
+            .select(Transfer, other.name.alias('counterparty'))
+            .join(other, on=(Transfer.to_accnt == other.id))
+            .where(Transfer.from_accnt == account)
+            .naive())
+    received = (Transfer
+                .select(Transfer, other.name.alias('counterparty'))
+                .join(other, on=(Transfer.from_accnt == other.id))
+                .where(Transfer.to_accnt == account)
+                .naive())
+    page = get_page([sent, received])
+    return render_template('account_transfers.html',
+                           account=account, page=page)
+
+
+@app.cli.command()
+def rebuild():
+    """Recomputes the daily balances from the ledger."""
+    click.echo('{} daily balances written'.format(rebuild_balances()))
+
+
+@app.cli.command()
+def verify():
+    """Recomputes every balance from the ledger and reports drift."""
+    drifted = verify_balances()
+    for account, expected in drifted:
+        click.echo('{}: stored ${}, ledger ${}, drift ${}'.format(
+            account.name, account.balance, expected,
+            account.balance - expected))
+    if drifted:
+        raise click.ClickException(
+            '{} account(s) have drifted from the ledger'.format(len(drifted)))
+    click.echo('All balances match the ledger')
+
+
+@app.cli.command('import')
+@click.argument('statement', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'statement_format',
+              type=click.Choice(importer.FORMATS), default='csv',
+              help='File format of the statement.')
+@click.option('--account', 'accnt_name', default=None,
+              help='Account to import into. Without it, every row must '
+                   'name its account in an "account" column.')
+def import_command(statement, statement_format, accnt_name):
+    """Imports a bank statement as entries."""
+    account = None
+    if accnt_name is not None:
+        try:
+            account = Account.get(Account.name == accnt_name)
+        except Account.DoesNotExist:
+            raise click.BadParameter('No account named {!r}'.format(
+                accnt_name), param_hint='--account')
+    try:
+        result = importer.import_statement(
+            statement, statement_format, account)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(result)
 
 
 if __name__ == "__main__":
     initialize()
-    app.run(debug=DEBUG, host=HOST, port=PORT)
+    # A snapshot replica takes its first copy before the first request.
+    replicas.app_replica(app)
+    app.run(debug=DEBUG, host=HOST, port=PORT, threaded=True)
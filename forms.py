@@ -1,12 +1,19 @@
 from flask_wtf import FlaskForm
-from wtforms import (DateField, DecimalField,
+from flask_wtf.file import FileField, FileRequired
+from wtforms import (DateField, DecimalField, HiddenField,
                      StringField, SelectField,
                      )
-from wtforms.validators import (DataRequired, ValidationError)
+from wtforms.validators import (DataRequired, Length, Optional,
+                                ValidationError)
 
 from not_equal_validator import NotEqualTo
 from models import Account
 
+TRANACT_TYPES = [
+    ('debit', 'DEBIT'),
+    ('credit', 'CREDIT'),
+]
+
 
 def account_exists(form, field):
     if Account.select().where(Account.name == field.data).exists():
@@ -66,10 +73,7 @@ class CreateEntryForm(FlaskForm):
     )
     tranact_type = SelectField(
         "Transaction Type:",
-        choices=[
-            ('debit', 'DEBIT'),
-            ('credit', 'CREDIT'),
-        ]
+        choices=TRANACT_TYPES,
     )
     amount = DecimalField(
         'Amount:',
@@ -84,6 +88,14 @@ class CreateEntryForm(FlaskForm):
     assc_accnt = SelectField(
         'Associated Account:'
     )
+    # Set when the form is rendered, so that submitting it twice
+    # creates one entry.
+    idempotency_key = HiddenField(
+        validators=[
+            Optional(),
+            Length(max=255),
+        ]
+    )
 
 
 class CreateTransferForm(FlaskForm):
@@ -119,4 +131,31 @@ class CreateTransferForm(FlaskForm):
         validators=[
             DataRequired(),
         ]
-    )
\ No newline at end of file
+    )
+    idempotency_key = HiddenField(
+        validators=[
+            Optional(),
+            Length(max=255),
+        ]
+    )
+
+
+class ImportStatementForm(FlaskForm):
+    statement = FileField(
+        'Statement File:',
+        validators=[
+            FileRequired(),
+        ]
+    )
+    statement_format = SelectField(
+        'Format:',
+        choices=[
+            ('csv', 'CSV'),
+            ('ofx', 'OFX'),
+        ]
+    )
+    # assc_accnt choices are appended to the form
+    # at the time of the request.
+    assc_accnt = SelectField(
+        'Associated Account:'
+    )
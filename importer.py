@@ -0,0 +1,196 @@
+"""Bulk import of bank statements (CSV or OFX) as entries.
+
+Statements are read one row at a time and inserted in batches inside a
+single transaction, so memory use does not grow with the size of the
+file. Each account's balance is then changed once, by the sum of its
+imported rows, instead of once per row.
+"""
+import csv
+import datetime
+import decimal
+import re
+import time
+
+from wtforms.validators import ValidationError
+
+from forms import must_be_positive, TRANACT_TYPES
+import metrics
+from models import (Account, as_stored, BalanceChanges, BATCH_SIZE,
+                    Entry, insert_journalled)
+
+FORMATS = ('csv', 'ofx')
+
+
+class StatementError(ValueError):
+    """Raised when a row of a statement fails validation."""
+    def __init__(self, line, message):
+        self.line = line
+        ValueError.__init__(
+            self, 'Line {}: {}'.format(line, message))
+
+
+class ImportResult(object):
+    def __init__(self, rows, seconds):
+        self.rows = rows
+        self.seconds = seconds
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return 'Imported {} rows in {:.2f}s ({:.0f} rows/sec)'.format(
+            self.rows, self.seconds, self.rows_per_sec)
+
+
+class _Field(object):
+    """Stands in for a form field, so that rows can be checked with the
+    validators in forms.py.
+    """
+    def __init__(self, data):
+        self.data = data
+
+
+def read_csv(lines):
+    """Yields ``(line, row)`` pairs from a CSV statement with a header
+    row. The columns used are ``date`` (YYYY-MM-DD), ``description``
+    and ``amount``, plus optional ``type`` and ``account`` columns.
+    Without a ``type`` column, negative amounts are debits and positive
+    ones credits.
+    """
+    reader = csv.DictReader(lines)
+    for row in reader:
+        row = dict((key.strip().lower(), (value or '').strip())
+                   for key, value in row.items() if key)
+        yield reader.line_num, {
+            'date': row.get('date', ''),
+            'descrip': row.get('description', row.get('descrip', '')),
+            'amount': row.get('amount', ''),
+            'tranact_type': row.get('type', row.get('tranact_type')),
+            'account': row.get('account'),
+        }
+
+
+_ofx_tag = re.compile(r'<(/?)(\w+)>([^<\r\n]*)')
+
+
+def read_ofx(lines):
+    """Yields ``(line, row)`` pairs for the STMTTRN records of an OFX
+    statement (SGML or XML).
+    """
+    record = None
+    for number, text in enumerate(lines, 1):
+        for closing, tag, value in _ofx_tag.findall(text):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                if closing and record is not None:
+                    yield record.pop('line'), {
+                        'date': record.get('DTPOSTED', '')[:8],
+                        'descrip': record.get('NAME') or record.get('MEMO', ''),
+                        'amount': record.get('TRNAMT', ''),
+                        'tranact_type': None,
+                        'account': None,
+                    }
+                    record = None
+                elif not closing:
+                    record = {'line': number}
+            elif record is not None and not closing:
+                record[tag] = value.strip()
+
+
+READERS = {
+    'csv': read_csv,
+    'ofx': read_ofx,
+}
+
+
+def _parse_date(value):
+    for fmt in ('%Y-%m-%d', '%Y%m%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError('Invalid date: {!r}'.format(value))
+
+
+def validate(line, row):
+    """Applies the rules of CreateEntryForm to a statement row, and
+    returns ``(descrip, date, tranact_type, amount)``.
+    """
+    if not row['descrip']:
+        raise StatementError(line, 'Description is required.')
+    try:
+        date = _parse_date(row['date'])
+        amount = decimal.Decimal(row['amount'])
+    except (ValueError, decimal.InvalidOperation) as e:
+        raise StatementError(line, e)
+    if not amount.is_finite():
+        raise StatementError(
+            line, 'Invalid amount: {!r}'.format(row['amount']))
+
+    tranact_type = row['tranact_type']
+    if not tranact_type:
+        tranact_type = 'debit' if amount < 0 else 'credit'
+        amount = abs(amount)
+    tranact_type = tranact_type.lower()
+    if tranact_type not in dict(TRANACT_TYPES):
+        raise StatementError(
+            line, 'Invalid transaction type: {!r}'.format(tranact_type))
+    try:
+        must_be_positive(None, _Field(amount))
+    except ValidationError as e:
+        raise StatementError(line, e)
+    return row['descrip'], date, tranact_type, amount
+
+
+def import_statement(lines, statement_format='csv', account=None,
+                     batch_size=BATCH_SIZE):
+    """Imports every row of a statement as an entry, in one transaction.
+
+    Rows go to ``account`` or, if it is None, to the account named in
+    the row's ``account`` column. Raises StatementError, and imports
+    nothing, if any row is invalid. Returns an ImportResult.
+    """
+    started = time.time()
+    database = Entry._meta.database
+    if account is None:
+        accounts = dict(Account.select(Account.name, Account.id).tuples())
+
+    changes = BalanceChanges()
+    batch = []
+    count = 0
+    with database.transaction():
+        for line, row in READERS[statement_format](lines):
+            descrip, date, tranact_type, amount = validate(line, row)
+            if account is not None:
+                accnt_id = account.id
+            elif row['account'] in accounts:
+                accnt_id = accounts[row['account']]
+            else:
+                raise StatementError(
+                    line, 'Unknown account: {!r}'.format(row['account']))
+            if accnt_id not in changes.deltas:
+                # Locked before any of its rows is written, as in
+                # Entry.create_entries().
+                Account.lock(accnt_id)
+
+            batch.append(Entry(
+                descrip=descrip,
+                date=date,
+                tranact_type=tranact_type,
+                amount=amount,
+                assc_accnt=accnt_id,
+            ))
+            # Changed by what is stored, which is rounded to the cent.
+            amount = as_stored(Entry.amount, amount)
+            changes.add(accnt_id,
+                        -amount if tranact_type == 'debit' else amount)
+            count += 1
+            if len(batch) >= batch_size:
+                insert_journalled(Entry, batch)
+                batch = []
+        if batch:
+            insert_journalled(Entry, batch)
+        changes.apply()
+    metrics.INSERTS.inc(count, table='entry')
+    return ImportResult(count, time.time() - started)
@@ -0,0 +1,131 @@
+"""Per-request SQL instrumentation.
+
+Once a database is instrumented, every statement it runs while a
+request is being handled is counted and timed. The totals go out with
+the response in a ``Server-Timing`` header, and one structured (JSON)
+log line is written per request to the ``flask_ledger.sql`` logger.
+Statements slower than the app's ``SLOW_QUERY_MS`` setting are logged
+on their own, with their parameters and the view that ran them.
+"""
+import heapq
+import json
+import logging
+import time
+
+from flask import current_app, g, has_request_context, request
+
+import metrics
+
+logger = logging.getLogger('flask_ledger.sql')
+
+# How many of a request's slowest statements are logged.
+SLOWEST = 3
+
+
+class QueryStats(object):
+    """The statements run during one request."""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.seconds = 0.0
+        # A min-heap of the SLOWEST slowest (seconds, sql) pairs.
+        self.slowest = []
+
+    def record(self, sql, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if len(self.slowest) < SLOWEST:
+            heapq.heappush(self.slowest, (seconds, sql))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, sql))
+
+    def server_timing(self):
+        return 'db;desc="{} queries";dur={:.2f}, app;dur={:.2f}'.format(
+            self.count, self.seconds * 1000,
+            (time.perf_counter() - self.started) * 1000)
+
+
+def _log(event, **fields):
+    fields['event'] = event
+    return json.dumps(fields, default=str, sort_keys=True)
+
+
+def _record(sql, params, seconds):
+    if not has_request_context() or 'sql_stats' not in g:
+        return
+    g.sql_stats.record(sql, seconds)
+    threshold = current_app.config.get('SLOW_QUERY_MS')
+    if threshold is not None and seconds * 1000 >= threshold:
+        logger.warning(_log(
+            'slow_query',
+            method=request.method,
+            path=request.path,
+            endpoint=request.endpoint,
+            duration_ms=round(seconds * 1000, 3),
+            sql=sql,
+            params=list(params or ())))
+
+
+def instrument(database):
+    """Wraps ``database.execute_sql`` so that statements run during a
+    request are recorded, and ``database.rollback`` so that rollbacks
+    are counted in metrics.ROLLBACKS. Instrumenting a database twice
+    does nothing.
+    """
+    if getattr(database, 'instrumented', False):
+        return
+    execute_sql = database.execute_sql
+    rollback = database.rollback
+
+    def timed_execute_sql(sql, params=None, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return execute_sql(sql, params, *args, **kwargs)
+        finally:
+            _record(sql, params, time.perf_counter() - started)
+
+    def counted_rollback():
+        metrics.ROLLBACKS.inc()
+        return rollback()
+
+    database.execute_sql = timed_execute_sql
+    database.rollback = counted_rollback
+    database.instrumented = True
+
+
+def start_request(database):
+    """Starts recording the current request's statements."""
+    instrument(database)
+    g.sql_stats = QueryStats()
+
+
+def add_server_timing(response):
+    """Adds the request's statement count and SQL time, as they stand,
+    to ``response``. Streamed responses may run more statements after
+    this; those are only in the log.
+    """
+    if 'sql_stats' in g:
+        response.headers.add('Server-Timing', g.sql_stats.server_timing())
+        g.sql_status = response.status_code
+    return response
+
+
+def finish_request():
+    """Writes the request's log line, and returns its QueryStats (None
+    if start_request() was not called).
+    """
+    stats = g.pop('sql_stats', None)
+    if stats is None:
+        return None
+    logger.info(_log(
+        'request',
+        method=request.method,
+        path=request.path,
+        endpoint=request.endpoint,
+        status=g.get('sql_status'),
+        queries=stats.count,
+        sql_ms=round(stats.seconds * 1000, 3),
+        duration_ms=round((time.perf_counter() - stats.started) * 1000, 3),
+        slowest=[{'sql': sql, 'ms': round(seconds * 1000, 3)}
+                 for seconds, sql in sorted(stats.slowest, reverse=True)]))
+    return stats
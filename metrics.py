@@ -0,0 +1,237 @@
+"""Counters, gauges and histograms in the Prometheus text format.
+
+Recording is meant to be cheap enough for the request path. Every
+thread writes to its own shard of each metric, so recording takes no
+lock and threads never contend for the same value; a lock is only
+taken the first time a thread records a metric. Reading a metric (for
+/metrics) adds the shards up. The shards of threads that have exited
+are folded into one, so a server that starts a thread per request does
+not accumulate them.
+"""
+import threading
+
+# Upper bounds, in seconds, of the default histogram buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+class _Shards(object):
+    """Per-thread dicts of values, keyed by label values."""
+    def __init__(self, merge):
+        self._merge = merge
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._live = []
+        self._retired = {}
+
+    def shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._live.append((threading.current_thread(), shard))
+            return shard
+
+    def merged(self):
+        """Returns the sum of every shard."""
+        with self._lock:
+            live = []
+            for thread, shard in self._live:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    self._merge_into(self._retired, shard)
+            self._live = live
+            total = {}
+            self._merge_into(total, self._retired)
+            for thread, shard in live:
+                self._merge_into(total, shard)
+        return total
+
+    def _merge_into(self, total, shard):
+        # list() copies the items without letting the owning thread
+        # add a key part way through.
+        for key, value in list(shard.items()):
+            total[key] = (self._merge(total[key], value) if key in total
+                          else self._merge(None, value))
+
+
+def _key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError('Expected labels {}, got {}'.format(
+            labelnames, sorted(labels)))
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value))
+                          for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), register=True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        if register:
+            REGISTRY.append(self)
+
+    def samples(self):
+        """Returns ``(suffix, labels, value)`` for every sample."""
+        raise NotImplementedError
+
+    def exposition(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, labels, _number(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super(Counter, self).__init__(*args, **kwargs)
+        self._shards = _Shards(lambda total, value: (total or 0) + value)
+
+    def inc(self, amount=1, **labels):
+        shard = self._shards.shard()
+        key = _key(self.labelnames, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._shards.merged().get(_key(self.labelnames, labels), 0)
+
+    def samples(self):
+        return [('', _labels(self.labelnames, key), value)
+                for key, value in sorted(self._shards.merged().items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS,
+                 **kwargs):
+        super(Histogram, self).__init__(name, documentation, labelnames,
+                                        **kwargs)
+        self.buckets = tuple(sorted(map(float, buckets))) + (float('inf'),)
+        self._shards = _Shards(self._merge)
+
+    @staticmethod
+    def _merge(total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def observe(self, value, **labels):
+        """Records ``value``. Each shard holds a count per bucket (not
+        cumulative), followed by the sum of the values.
+        """
+        shard = self._shards.shard()
+        key = _key(self.labelnames, labels)
+        counts = shard.get(key)
+        if counts is None:
+            counts = shard[key] = [0] * (len(self.buckets) + 1)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-1] += value
+
+    def count(self, **labels):
+        counts = self._shards.merged().get(_key(self.labelnames, labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        samples = []
+        for key, counts in sorted(self._shards.merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(('_bucket', _labels(
+                    self.labelnames, key, [('le', _number(bound))]),
+                    cumulative))
+            labels = _labels(self.labelnames, key)
+            samples.append(('_sum', labels, counts[-1]))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+class Gauge(Metric):
+    """A value read when the metrics are collected. ``collect`` returns
+    a list of ``(labels, value)`` pairs.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None,
+                 **kwargs):
+        super(Gauge, self).__init__(name, documentation, labelnames,
+                                    **kwargs)
+        self.collect = collect
+
+    def samples(self):
+        return [('', _labels(self.labelnames, _key(self.labelnames, labels)),
+                 value)
+                for labels, value in self.collect()]
+
+
+def exposition(registry=None):
+    """Returns every metric in ``registry`` in the Prometheus text
+    format.
+    """
+    return '\n'.join(metric.exposition()
+                     for metric in (registry or REGISTRY)) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REQUEST_SECONDS = Histogram(
+    'ledger_request_duration_seconds',
+    'Time taken to handle a request, by endpoint.', ('endpoint',))
+REQUEST_DB_SECONDS = Histogram(
+    'ledger_request_db_seconds',
+    'Time spent running SQL during a request, by endpoint.', ('endpoint',))
+DB_CONNECT_SECONDS = Histogram(
+    'ledger_db_connection_wait_seconds',
+    'Time taken to get a database connection from the pool.')
+INSERTS = Counter(
+    'ledger_inserts_total', 'Entries and transfers written.', ('table',))
+ROLLBACKS = Counter(
+    'ledger_transaction_rollbacks_total', 'Transactions rolled back.')
+WRITE_BATCH_ROWS = Histogram(
+    'ledger_write_batch_rows',
+    'Rows committed together by the write queue.',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+PAGE_CACHE = Counter(
+    'ledger_page_cache_total',
+    'Cacheable page requests, by result: not_modified, hit or miss.',
+    ('result',))
+TENANT_EVICTIONS = Counter(
+    'ledger_tenant_evictions_total',
+    'Tenant databases closed to open another, once TENANT_MAX_OPEN are.')
+REPLICA_READS = Counter(
+    'ledger_replica_reads_total',
+    'Read-only requests, by the database that served them: replica, or '
+    'primary while the replica lacked the session\'s writes.',
+    ('database',))
@@ -0,0 +1,201 @@
+"""Schema migrations for existing ledger databases.
+
+initialize() creates any missing tables, but it can not change tables
+that already exist. Each migration below brings an older table up to
+date and does nothing if the change has already been made, so
+migrate_database() can be run every time the app starts.
+"""
+import collections
+
+from peewee import SqliteDatabase
+from playhouse.migrate import migrate, SchemaMigrator
+
+from models import (Account, DailyBalance, Entry, LedgerVersion, MODELS,
+                    Posting, Transfer)
+from money_field import MoneyField
+import search
+
+
+def _columns(database, table):
+    return set(column.name for column in database.get_columns(table))
+
+
+def _ledger_deltas_sql():
+    """Returns a UNION ALL query yielding one ``(accnt, date, delta)``
+    row per balance change, read from the entry and transfer tables:
+    ledgers this old have no postings yet.
+    """
+    return (
+        "SELECT assc_accnt_id AS accnt, date, "
+        "CASE WHEN tranact_type = 'credit' THEN amount ELSE -amount END "
+        "AS delta FROM {entry} "
+        "UNION ALL "
+        "SELECT from_accnt_id AS accnt, date, -amount AS delta "
+        "FROM {transfer} "
+        "UNION ALL "
+        "SELECT to_accnt_id AS accnt, date, amount AS delta "
+        "FROM {transfer}"
+    ).format(entry=Entry._meta.db_table, transfer=Transfer._meta.db_table)
+
+
+def add_opening_balance(database, migrator):
+    """Adds Account.opening_balance, backfilled with the balance each
+    account had before its entries and transfers.
+    """
+    table = Account._meta.db_table
+    if 'opening_balance' in _columns(database, table):
+        return
+    migrate(migrator.add_column(
+        table, 'opening_balance', Account.opening_balance))
+    database.execute_sql(
+        'UPDATE {table} SET opening_balance = balance - COALESCE('
+        '(SELECT SUM(delta) FROM ({deltas}) AS d '
+        'WHERE d.accnt = {table}.id), 0)'.format(
+            table=table, deltas=_ledger_deltas_sql()))
+
+
+def _rebuild_table(database, model, select):
+    """Recreates ``model``'s table from the model's current definition,
+    copying the existing rows across. ``select`` maps each column name
+    to the SQL expression its value is read from.
+    """
+    table = model._meta.db_table
+    for index in database.get_indexes(table):
+        if index.sql:
+            database.execute_sql('DROP INDEX "{}"'.format(index.name))
+
+    model._meta.db_table = table + '__new'
+    try:
+        database.create_table(model)
+    finally:
+        model._meta.db_table = table
+    database.execute_sql(
+        'INSERT INTO "{new}" ({columns}) SELECT {exprs} FROM "{old}"'.format(
+            new=table + '__new',
+            old=table,
+            columns=', '.join('"{}"'.format(column) for column in select),
+            exprs=', '.join(select.values())))
+    database.execute_sql('DROP TABLE "{}"'.format(table))
+    database.execute_sql('ALTER TABLE "{}__new" RENAME TO "{}"'.format(
+        table, table))
+    model._create_indexes()
+
+
+def use_money_fields(database, migrator):
+    """Converts money columns that still hold floating point amounts
+    (REAL columns, in SQLite) into integer minor units.
+    """
+    if not isinstance(database, SqliteDatabase):
+        return
+    for model in (Account, Entry, Transfer):
+        columns = dict((column.name, column.data_type.upper())
+                       for column in database.get_columns(
+                           model._meta.db_table))
+        money = [field for field in model._meta.sorted_fields
+                 if isinstance(field, MoneyField)]
+        if all(columns[field.db_column] != 'REAL' for field in money):
+            continue
+        # Columns added by later migrations are left to those.
+        select = collections.OrderedDict(
+            (field.db_column, '"{}"'.format(field.db_column))
+            for field in model._meta.sorted_fields
+            if field.db_column in columns)
+        for field in money:
+            select[field.db_column] = (
+                'CAST(ROUND("{}" * {}) AS INTEGER)'.format(
+                    field.db_column, 10 ** field.places))
+        _rebuild_table(database, model, select)
+
+
+def add_idempotency_keys(database, migrator):
+    """Adds the idempotency_key column to Entry and Transfer. Its
+    unique index is made by add_missing_indexes().
+    """
+    for model in (Entry, Transfer):
+        table = model._meta.db_table
+        if 'idempotency_key' not in _columns(database, table):
+            migrate(migrator.add_column(
+                table, 'idempotency_key', model.idempotency_key))
+
+
+def add_postings(database, migrator):
+    """Journals the entries and transfers of a ledger that predates
+    Posting.
+    """
+    Posting.create_table(fail_silently=True)
+    if Posting.select().exists():
+        return
+    Posting.backfill()
+
+
+def add_daily_balances(database, migrator):
+    """Fills DailyBalance from the journal of a ledger that predates
+    it.
+    """
+    DailyBalance.create_table(fail_silently=True)
+    if not DailyBalance.select().exists():
+        DailyBalance.rebuild()
+
+
+def drop_balance_snapshots(database, migrator):
+    """Drops the monthly balance snapshots that DailyBalance replaced."""
+    database.execute_sql('DROP TABLE IF EXISTS "balancesnapshot"')
+
+
+def add_search_index(database, migrator):
+    """Creates the full-text index of descriptions (see search.py),
+    where the database supports one.
+    """
+    search.create_index(database)
+
+
+def add_missing_indexes(database, migrator):
+    """Creates the indexes declared on the models (e.g. the composite
+    ``(assc_accnt, date)`` index on Entry) that an older table lacks.
+    """
+    for model in MODELS:
+        # Compared unordered, as peewee lists a Postgres index's columns
+        # in the table's order rather than the index's.
+        existing = set(frozenset(index.columns) for index in
+                       database.get_indexes(model._meta.db_table))
+        for fields, unique in model._index_data():
+            columns = tuple(model._meta.fields.get(field, field).db_column
+                            for field in fields)
+            if frozenset(columns) not in existing:
+                migrate(migrator.add_index(
+                    model._meta.db_table, columns, unique))
+
+
+def add_ledger_version(database, migrator):
+    """Gives a ledger that predates LedgerVersion its first version, so
+    that its pages can be cached before the next write, and adds the
+    account version to an older LedgerVersion table.
+    """
+    LedgerVersion.create_table(fail_silently=True)
+    table = LedgerVersion._meta.db_table
+    if 'accounts' not in _columns(database, table):
+        migrate(migrator.add_column(
+            table, 'accounts', LedgerVersion.accounts))
+    if not LedgerVersion.select().exists():
+        LedgerVersion.bump()
+
+
+MIGRATIONS = [
+    add_opening_balance,
+    use_money_fields,
+    add_idempotency_keys,
+    add_postings,
+    add_daily_balances,
+    drop_balance_snapshots,
+    add_search_index,
+    add_missing_indexes,
+    add_ledger_version,
+]
+
+
+def migrate_database(database):
+    """Runs every migration against ``database`` in one transaction."""
+    migrator = SchemaMigrator.from_database(database)
+    with database.transaction():
+        for migration in MIGRATIONS:
+            migration(database, migrator)
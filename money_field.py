@@ -0,0 +1,44 @@
+"""A peewee field that stores amounts of money as a whole number of
+minor units (cents, by default), so that the database adds them up
+exactly."""
+import decimal
+
+from peewee import BigIntegerField
+
+
+class MoneyField(BigIntegerField):
+    """
+    Stores a decimal amount as an integer count of minor units.
+    :param places:
+        Number of decimal places in the currency's minor unit, e.g. 2
+        for cents.
+    :param rounding:
+        Rounding mode used for amounts with more places than that.
+    Values are returned as ``decimal.Decimal``. An aggregate over the
+    column (e.g. ``fn.SUM``) is an integer number of minor units, which
+    ``python_value()`` turns back into an amount.
+    """
+    def __init__(self, places=2, rounding=decimal.ROUND_HALF_UP,
+                 *args, **kwargs):
+        self.places = places
+        self.rounding = rounding
+        super(MoneyField, self).__init__(*args, **kwargs)
+
+    def clone_base(self, **kwargs):
+        return super(MoneyField, self).clone_base(
+            places=self.places,
+            rounding=self.rounding,
+            **kwargs)
+
+    def db_value(self, value):
+        if value is None:
+            return value
+        if not isinstance(value, decimal.Decimal):
+            value = decimal.Decimal(str(value))
+        return int(value.scaleb(self.places).to_integral_value(
+            rounding=self.rounding))
+
+    def python_value(self, value):
+        if value is None:
+            return value
+        return decimal.Decimal(int(value)).scaleb(-self.places)
@@ -0,0 +1,122 @@
+"""Caching of pages that are derived from the ledger alone.
+
+A page served by cached_page() carries an ETag made from the ledger
+version (see LedgerVersion), so a client that sends it back in
+If-None-Match gets a 304 until the ledger is next written to. The
+rendered HTML is also kept, keyed by the version and the page, so a
+client without the ETag is served it without it being rendered again.
+Neither reads a row while the version is unchanged.
+
+A page is only cached while the session has no flashed messages
+pending, as those are rendered into the page they are shown on. Each
+database has a cache of its own, so tenants' ledgers (see tenants.py)
+do not evict each other's pages.
+"""
+import collections
+import hashlib
+import threading
+import weakref
+
+from flask import current_app, make_response, request, session
+
+import metrics
+from models import LedgerVersion
+
+
+class PageCache(object):
+    """Rendered pages by key, for one ledger version at a time: storing
+    a page of another version drops every page stored before it.
+    """
+    def __init__(self, max_pages=1024):
+        self.max_pages = max_pages
+        self._lock = threading.Lock()
+        self._version = None
+        self._pages = collections.OrderedDict()
+
+    def get(self, version, key):
+        with self._lock:
+            if version != self._version or key not in self._pages:
+                return None
+            self._pages.move_to_end(key)
+            return self._pages[key]
+
+    def set(self, version, key, page):
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._pages.clear()
+            self._pages[key] = page
+            while len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._version = None
+            self._pages.clear()
+
+
+# PageCaches by database, dropped with their database.
+_CACHES = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+
+def pages(database):
+    """Returns the PageCache of ``database``."""
+    with _caches_lock:
+        cache = _CACHES.get(database)
+        if cache is None:
+            cache = _CACHES[database] = PageCache()
+        return cache
+
+
+def clear():
+    """Empties every PageCache."""
+    with _caches_lock:
+        caches = list(_CACHES.values())
+    for cache in caches:
+        cache.clear()
+
+
+def templates_digest(app):
+    """Returns a digest of the app's templates, so that ETags handed out
+    before the templates changed no longer match.
+    """
+    digest = app.extensions.get('templates_digest')
+    if digest is None:
+        env = app.jinja_env
+        sha = hashlib.sha1()
+        for name in sorted(env.list_templates()):
+            sha.update(env.loader.get_source(env, name)[0].encode('utf-8'))
+        digest = app.extensions['templates_digest'] = sha.hexdigest()[:12]
+    return digest
+
+
+def cached_page(key, render):
+    """Returns the response for a page rendered by ``render()``, which
+    must depend on nothing but ``key`` and the ledger.
+
+    The version is read before the page is rendered, so a write that
+    commits in between can only make the page newer than its ETag, in
+    which case the next request renders it again.
+    """
+    version = LedgerVersion.current()
+    if version is None or '_flashes' in session:
+        return make_response(render())
+    etag = 'ledger-{}-{}'.format(version, templates_digest(current_app))
+    if request.if_none_match.contains(etag):
+        metrics.PAGE_CACHE.inc(result='not_modified')
+        response = current_app.response_class(status=304)
+    else:
+        cache = pages(LedgerVersion._meta.database)
+        page = cache.get(version, key)
+        if page is None:
+            metrics.PAGE_CACHE.inc(result='miss')
+            page = render()
+            cache.set(version, key, page)
+        else:
+            metrics.PAGE_CACHE.inc(result='hit')
+        response = make_response(page)
+    response.set_etag(etag)
+    # Browsers may keep the page, but must check it is current first.
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
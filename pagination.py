@@ -0,0 +1,85 @@
+"""Keyset pagination over ledger history.
+
+History is listed newest first, ordered by ``(date, id)``. Instead of an
+OFFSET, each page is fetched by seeking past the ``(date, id)`` of the
+row at its edge, so that a deep page costs as much as the first one.
+"""
+import datetime
+
+from peewee import Tuple
+
+PER_PAGE = 25
+
+
+class Page(object):
+    """One page of rows, with the cursors of the neighbouring pages
+    (None when there is no such page).
+    """
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def encode_cursor(row):
+    return '{}_{}'.format(row.date, row.id)
+
+
+def decode_cursor(cursor):
+    """Parses a cursor into its ``(date, id)`` key. Raises ValueError
+    if the cursor is malformed.
+    """
+    date, sep, row_id = cursor.rpartition('_')
+    try:
+        return (datetime.datetime.strptime(date, '%Y-%m-%d').date(),
+                int(row_id))
+    except ValueError:
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+
+
+def _key(row):
+    return (str(row.date), row.id)
+
+
+def paginate(queries, after=None, before=None, per_page=PER_PAGE):
+    """Returns the Page of rows older than the ``after`` cursor, newer
+    than the ``before`` cursor, or the newest rows if neither is given.
+
+    ``queries`` is a list of select queries over models with ``date``
+    and ``id`` fields. Each is limited to one page before the results
+    are merged, so every query can be answered from an index on
+    ``(..., date)``.
+    """
+    backwards = before is not None
+    cursor = before if backwards else after
+    if cursor is not None:
+        cursor = decode_cursor(cursor)
+
+    rows = []
+    for query in queries:
+        model = query.model_class
+        key = Tuple(model.date, model.id)
+        if backwards:
+            query = query.where(key > Tuple(*cursor)).order_by(
+                model.date, model.id)
+        else:
+            if cursor is not None:
+                query = query.where(key < Tuple(*cursor))
+            query = query.order_by(model.date.desc(), model.id.desc())
+        rows.extend(query.limit(per_page + 1))
+
+    rows.sort(key=_key, reverse=not backwards)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    if not rows:
+        return Page(rows)
+
+    older = has_more if not backwards else True
+    newer = has_more if backwards else cursor is not None
+    return Page(
+        rows,
+        next_cursor=encode_cursor(rows[-1]) if older else None,
+        prev_cursor=encode_cursor(rows[0]) if newer else None,
+    )
@@ -0,0 +1,254 @@
+"""Routing of read-only requests to a replica of the ledger.
+
+With the app's READ_REPLICA setting, GET and HEAD requests are served
+from a replica, so that the dashboard and the account pages do not
+take connections, or SQLite's attention, from the writes. The setting
+is either:
+
+- ``'snapshot'``: a copy of the SQLite file, made with ``VACUUM INTO``
+  by a background thread every READ_REPLICA_REFRESH seconds if the
+  ledger has changed (see SnapshotReplica). Reads go to the primary
+  until the first copy has been made. Or:
+- the URL of a database that replicates this one, e.g. the same SQLite
+  file, for a connection pool of the reads' own (see DatabaseReplica).
+
+A replica may be behind. So that a session reads its own writes, the
+ledger version (see LedgerVersion) left by each request that may have
+written is kept in the session, and the session's reads go to the
+primary until the replica has that version.
+"""
+import atexit
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from urllib.request import pathname2url
+
+from flask import request, session
+
+import metrics
+from models import (bound_database, database_from_url, LedgerVersion,
+                    PRAGMAS, sqlite_database)
+
+logger = logging.getLogger('flask_ledger.replicas')
+
+# Requests that only read.
+READ_METHODS = ('GET', 'HEAD')
+
+# The session key of the version the session's last write left.
+SESSION_KEY = 'ledger_version'
+
+# Snapshots are never written to, and are copied again rather than
+# recovered after a crash.
+SNAPSHOT_PRAGMAS = tuple(
+    (name, value) for name, value in PRAGMAS
+    if name not in ('journal_mode', 'synchronous')) + (('query_only', 'on'),)
+
+_app_lock = threading.Lock()
+
+
+def includes(version, written):
+    """Returns whether a ledger at ``version`` has the write that left
+    it at ``written``. Either may be None: no write is needed, or the
+    ledger has none.
+    """
+    if written is None:
+        return True
+    if version is None:
+        return False
+    epoch, number = version.rsplit('-', 1)
+    written_epoch, written_number = written.rsplit('-', 1)
+    return epoch == written_epoch and int(number) >= int(written_number)
+
+
+def _version(database):
+    with bound_database(database):
+        opened = database.is_closed()
+        if opened:
+            database.connect()
+        try:
+            return LedgerVersion.current()
+        finally:
+            if opened:
+                database.close()
+
+
+class DatabaseReplica(object):
+    """A database that replicates the primary by other means."""
+    def __init__(self, database):
+        self.database = database
+
+    def current(self):
+        """Returns the replica's database and its ledger version."""
+        return self.database, _version(self.database)
+
+    def stop(self):
+        self.database.close_all()
+
+
+class SnapshotReplica(object):
+    """Copies of the SQLite database ``primary``, taken every
+    ``interval`` seconds while the ledger changes. Each copy is a new
+    file, opened read-only, so that requests reading the previous one
+    are not disturbed. A replaced copy is retired, so that connections
+    to it are closed as they are returned, and its file is deleted by
+    the refresh after, when no request can still be about to open it.
+    """
+    def __init__(self, primary, interval=1.0):
+        self.primary = primary
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._database = None
+        self._version = None
+        self._path = None
+        # The (database, path) of the copy replaced by the last refresh.
+        self._retired = None
+        self._copies = 0
+        self._dir = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the thread that takes the first copy and then
+        refreshes it. Until the first copy has been taken, current()
+        has no database.
+        """
+        self._dir = tempfile.mkdtemp(prefix='ledger-snapshot-')
+        self._thread = threading.Thread(
+            target=self._run, name='ledger-snapshot', daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """Waits for the first copy, and returns whether it was taken."""
+        return self._ready.wait(timeout)
+
+    def stop(self):
+        """Stops refreshing, and deletes the copies."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            database, self._database = self._database, None
+            retired, self._retired = self._retired, None
+        if retired is not None:
+            retired[0].retire()
+        if database is not None:
+            database.retire()
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+    def current(self):
+        """Returns the latest copy and its ledger version, or
+        ``(None, None)`` before the first copy.
+        """
+        with self._lock:
+            return self._database, self._version
+
+    def refresh(self):
+        """Copies the primary, unless the ledger has not changed since
+        the last copy. Returns whether it did.
+        """
+        if (self._database is not None and
+                _version(self.primary) == self._version):
+            return False
+        self._copies += 1
+        path = os.path.join(self._dir, 'ledger-{}.db'.format(self._copies))
+        opened = self.primary.is_closed()
+        if opened:
+            self.primary.connect()
+        try:
+            self.primary.execute_sql('VACUUM INTO ?', (path,))
+        finally:
+            if opened:
+                self.primary.close()
+        # Read-only, so that opening a copy that has been deleted fails
+        # rather than creating an empty database.
+        database = sqlite_database(
+            'file:{}?mode=ro'.format(pathname2url(path)),
+            pragmas=SNAPSHOT_PRAGMAS, uri=True)
+        # Read from the copy, as the ledger may have changed since the
+        # version above was read.
+        version = _version(database)
+        deleted = None
+        with self._lock:
+            previous, self._database = self._database, database
+            if previous is not None:
+                deleted, self._retired = self._retired, (previous,
+                                                         self._path)
+            self._path = path
+            self._version = version
+        self._ready.set()
+        if previous is not None:
+            # Requests that took it from current() may not have
+            # connected yet; it is deleted by the next refresh.
+            previous.retire()
+        if deleted is not None:
+            os.remove(deleted[1])
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                # E.g. the disk is full. Reads carry on from the last
+                # copy, or the primary.
+                logger.exception('Could not refresh the ledger snapshot')
+            if self._stop.wait(self.interval):
+                return
+
+
+def app_replica(app):
+    """Returns the app's replica, made from its READ_REPLICA and
+    READ_REPLICA_REFRESH settings, or None if READ_REPLICA is not set.
+    A snapshot replica copies the database the models are bound to when
+    it is made.
+    """
+    setting = app.config.get('READ_REPLICA')
+    if not setting:
+        return None
+    replica = app.extensions.get('replica')
+    if replica is None:
+        with _app_lock:
+            replica = app.extensions.get('replica')
+            if replica is None:
+                if setting == 'snapshot':
+                    replica = SnapshotReplica(
+                        LedgerVersion._meta.database,
+                        interval=app.config['READ_REPLICA_REFRESH'])
+                    replica.start()
+                else:
+                    replica = DatabaseReplica(database_from_url(setting))
+                atexit.register(replica.stop)
+                app.extensions['replica'] = replica
+    return replica
+
+
+def read_database(app):
+    """Returns the database to serve the current request from, if that
+    is the app's replica: the request only reads, and the replica has
+    every write the session has made. Otherwise returns None.
+    """
+    replica = app_replica(app)
+    if replica is None or request.method not in READ_METHODS:
+        return None
+    database, version = replica.current()
+    if database is None or not includes(version, session.get(SESSION_KEY)):
+        metrics.REPLICA_READS.inc(database='primary')
+        return None
+    metrics.REPLICA_READS.inc(database='replica')
+    return database
+
+
+def remember_writes(app):
+    """Keeps the ledger version in the session after a request that may
+    have written, if the app has a replica.
+    """
+    if (app_replica(app) is None or request.method in READ_METHODS or
+            LedgerVersion._meta.database.is_closed()):
+        return
+    version = LedgerVersion.current()
+    if version is not None and session.get(SESSION_KEY) != version:
+        session[SESSION_KEY] = version
@@ -0,0 +1,184 @@
+"""Ledger reports: monthly cash flow, net transfer flows between
+accounts and an account's running balance.
+
+Every report is aggregated by the database (GROUP BY, and a window
+function for the running balance), so at most one row per account and
+day, or pair of accounts, is read back, never one per entry. The
+covering ``(date, ...)`` indexes on Entry and Transfer let a report
+over a date range read only that range of an index, and the running
+balance reads one account's range of the journal's index.
+"""
+import datetime
+
+from peewee import PostgresqlDatabase
+
+from balances import deltas_sql, PERIODS, to_money
+from models import Account, Entry, Posting, Transfer
+
+# Reports without a start date cover this many months, up to the end
+# date.
+DEFAULT_MONTHS = 12
+
+
+def default_start(end):
+    """Returns the first day of the month DEFAULT_MONTHS - 1 months
+    before ``end``.
+    """
+    months = end.year * 12 + end.month - DEFAULT_MONTHS
+    return datetime.date(months // 12, months % 12 + 1, 1)
+
+
+def _period_sql(database, period, column='date'):
+    """Returns the SQL expression grouping ``column`` by ``period``.
+    SQLite stores dates as YYYY-MM-DD text.
+    """
+    if period not in PERIODS:
+        raise ValueError('Unknown period: {}'.format(period))
+    if period == 'day':
+        return column
+    if isinstance(database, PostgresqlDatabase):
+        return "to_char({}, 'YYYY-MM')".format(column)
+    return 'substr({}, 1, 7)'.format(column)
+
+
+def _str(value):
+    return value if isinstance(value, str) else value.isoformat()
+
+
+def _account_names():
+    return dict((int(accnt_id), name)
+                for accnt_id, name in Account.cached_choices())
+
+
+def cash_flow(start, end, accnt_id=None):
+    """Returns one row per account and month between ``start`` and
+    ``end``, with the month's credited and debited entries, the
+    transfers in and out, and the net change. Money is returned as
+    strings.
+
+    The database sums the rows of each account and day, in the order of
+    the covering date indexes, so no sort is needed; the much smaller
+    daily totals are then added up by month here.
+    """
+    database = Entry._meta.database
+    param = database.interpolation
+    where = 'date >= {0} AND date <= {0}'.format(param)
+    params = [start, end]
+    if accnt_id is not None:
+        where += ' AND {{accnt}} = {}'.format(param)
+        params.append(accnt_id)
+
+    queries = [
+        ('SELECT date, assc_accnt_id, '
+         "SUM(CASE WHEN tranact_type = 'credit' THEN amount ELSE 0 END), "
+         "SUM(CASE WHEN tranact_type = 'debit' THEN amount ELSE 0 END) "
+         'FROM {entry} WHERE {where} GROUP BY date, assc_accnt_id',
+         ('credits', 'debits'), 'assc_accnt_id'),
+        ('SELECT date, from_accnt_id, SUM(amount) '
+         'FROM {transfer} WHERE {where} GROUP BY date, from_accnt_id',
+         ('transfers_out',), 'from_accnt_id'),
+        ('SELECT date, to_accnt_id, SUM(amount) '
+         'FROM {transfer} WHERE {where} GROUP BY date, to_accnt_id',
+         ('transfers_in',), 'to_accnt_id'),
+    ]
+    totals = {}
+    for sql, columns, accnt in queries:
+        cursor = database.execute_sql(sql.format(
+            entry=Entry._meta.db_table,
+            transfer=Transfer._meta.db_table,
+            where=where.format(accnt=accnt)), params)
+        for row in cursor:
+            key = row[1], _str(row[0])[:7]
+            if key not in totals:
+                totals[key] = dict.fromkeys(
+                    ('credits', 'debits', 'transfers_in', 'transfers_out'),
+                    0)
+            for column, value in zip(columns, row[2:]):
+                totals[key][column] += value or 0
+
+    names = _account_names()
+    rows = []
+    for (row_accnt_id, month), total in sorted(totals.items()):
+        net = (total['credits'] - total['debits'] +
+               total['transfers_in'] - total['transfers_out'])
+        row = {'account_id': row_accnt_id,
+               'account': names.get(row_accnt_id),
+               'month': month,
+               'net': str(to_money(net))}
+        row.update((column, str(to_money(value)))
+                   for column, value in total.items())
+        rows.append(row)
+    return rows
+
+
+def transfer_flows(start, end, accnt_id=None):
+    """Returns the net amount transferred between each pair of accounts
+    between ``start`` and ``end``, largest first. Each row names the
+    account the money went to on balance, and counts the transfers
+    either way.
+    """
+    database = Transfer._meta.database
+    param = database.interpolation
+    where = 'date >= {0} AND date <= {0}'.format(param)
+    params = [start, end]
+    if accnt_id is not None:
+        where += ' AND (from_accnt_id = {0} OR to_accnt_id = {0})'.format(
+            param)
+        params.extend([accnt_id, accnt_id])
+    cursor = database.execute_sql(
+        'SELECT from_accnt_id, to_accnt_id, COUNT(*), SUM(amount) '
+        'FROM {transfer} WHERE {where} '
+        'GROUP BY from_accnt_id, to_accnt_id'.format(
+            transfer=Transfer._meta.db_table, where=where),
+        params)
+
+    # Transfers a -> b and b -> a are netted against each other.
+    pairs = {}
+    for from_id, to_id, count, amount in cursor:
+        pair = tuple(sorted((from_id, to_id)))
+        if pair not in pairs:
+            pairs[pair] = [0, to_money(0)]
+        pairs[pair][0] += count
+        if (from_id, to_id) == pair:
+            pairs[pair][1] += to_money(amount)
+        else:
+            pairs[pair][1] -= to_money(amount)
+
+    names = _account_names()
+    rows = []
+    for (low, high), (count, net) in pairs.items():
+        from_id, to_id = (low, high) if net >= 0 else (high, low)
+        rows.append({'from_account_id': from_id,
+                     'from_account': names.get(from_id),
+                     'to_account_id': to_id,
+                     'to_account': names.get(to_id),
+                     'transfers': count,
+                     'amount': abs(net)})
+    rows.sort(key=lambda row: (-row['amount'], row['from_account_id'],
+                               row['to_account_id']))
+    for row in rows:
+        row['amount'] = str(row['amount'])
+    return rows
+
+
+def running_balance(account, start, end, period='day'):
+    """Returns ``account``'s balance at the end of every day (or month)
+    with activity between ``start`` and ``end``, together with that
+    period's change. The balance before ``start`` comes from
+    Account.balance_as_of(); the rest is a running sum over the grouped
+    changes.
+    """
+    database = Posting._meta.database
+    param = database.interpolation
+    group = _period_sql(database, period)
+    opening = account.balance_as_of(start - datetime.timedelta(days=1))
+    where = 'account_id = {0} AND date >= {0} AND date <= {0}'.format(param)
+    cursor = database.execute_sql(
+        'SELECT {group}, SUM(delta), SUM(SUM(delta)) OVER (ORDER BY {group}) '
+        'FROM ({deltas}) AS deltas GROUP BY {group} ORDER BY {group}'.format(
+            group=group, deltas=deltas_sql(where)),
+        [account.id, start, end])
+    return [{'date': _str(date),
+             'change': str(to_money(change)),
+             'balance': str(opening + to_money(running))}
+            for date, change, running in cursor]
@@ -0,0 +1,168 @@
+"""Full-text search over the descriptions of entries and transfers.
+
+The ``ledger_search`` table is an SQLite FTS5 index of both tables'
+descriptions. It is contentless: it holds the index but not the text,
+which stays in the entry and transfer tables. Row ``2 * id`` is entry
+``id`` and row ``2 * id + 1`` is transfer ``id``, so the two are
+ranked against each other. Triggers on the two tables keep the index
+in sync with every insert, update and delete, whichever code makes
+them.
+
+Other databases, and SQLite builds without FTS5, have no search.
+"""
+import re
+
+from peewee import SqliteDatabase
+
+from models import Entry, Transfer
+
+TABLE = 'ledger_search'
+
+# (trigger name prefix, model, rowid expression) for each indexed table.
+_SOURCES = (
+    ('entry_search', Entry, '{row}.id * 2'),
+    ('transfer_search', Transfer, '{row}.id * 2 + 1'),
+)
+
+
+class SearchUnavailable(Exception):
+    pass
+
+
+def _triggers():
+    """Returns ``{name: CREATE TRIGGER statement}``."""
+    insert = ('INSERT INTO {fts} (rowid, descrip) '
+              'VALUES ({rowid_new}, new.descrip)')
+    delete = ("INSERT INTO {fts} ({fts}, rowid, descrip) "
+              "VALUES ('delete', {rowid_old}, old.descrip)")
+    triggers = {}
+    for name, model, rowid in _SOURCES:
+        add = insert.format(fts=TABLE, rowid_new=rowid.format(row='new'))
+        remove = delete.format(fts=TABLE, rowid_old=rowid.format(row='old'))
+        for suffix, event, body in (
+                ('insert', 'INSERT', [add]),
+                ('delete', 'DELETE', [remove]),
+                ('update', 'UPDATE OF id, descrip', [remove, add])):
+            trigger = '{}_{}'.format(name, suffix)
+            triggers[trigger] = (
+                'CREATE TRIGGER IF NOT EXISTS {} AFTER {} ON {} '
+                'BEGIN {}; END'.format(trigger, event, model._meta.db_table,
+                                       '; '.join(body)))
+    return triggers
+
+
+def available(database):
+    """Returns whether ``database`` can have a search index."""
+    if not isinstance(database, SqliteDatabase):
+        return False
+    cursor = database.execute_sql(
+        "SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+    return bool(cursor.fetchone()[0])
+
+
+def create_index(database):
+    """Creates the search index and its triggers, and fills it from the
+    existing rows, unless the triggers are already in place. Returns
+    False if ``database`` can not have one.
+    """
+    if not available(database):
+        return False
+    triggers = _triggers()
+    existing = set(name for name, in database.execute_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger'"))
+    if set(triggers) <= existing:
+        return True
+    # Without its triggers the index may have missed writes.
+    database.execute_sql('DROP TABLE IF EXISTS {}'.format(TABLE))
+    database.execute_sql(
+        "CREATE VIRTUAL TABLE {} USING fts5(descrip, content='', "
+        "prefix='2 3')".format(TABLE))
+    for sql in triggers.values():
+        database.execute_sql(sql)
+    database.execute_sql(
+        'INSERT INTO {fts} (rowid, descrip) '
+        'SELECT id * 2, descrip FROM {entry} UNION ALL '
+        'SELECT id * 2 + 1, descrip FROM {transfer}'.format(
+            fts=TABLE, entry=Entry._meta.db_table,
+            transfer=Transfer._meta.db_table))
+    return True
+
+
+def drop_index(database):
+    """Drops the search index and its triggers."""
+    for name in _triggers():
+        database.execute_sql('DROP TRIGGER IF EXISTS {}'.format(name))
+    database.execute_sql('DROP TABLE IF EXISTS {}'.format(TABLE))
+
+
+def match_expression(query):
+    """Turns what a user typed into an FTS5 query matching rows that
+    have every word of it. The last word may be the start of a word
+    (``star`` finds "Starbucks"), as it may not have been typed in full.
+    Returns None if it has no words.
+    """
+    words = ['"{}"'.format(word) for word in re.findall(r'\w+', query)]
+    if not words:
+        return None
+    # Only the last word is a prefix: FTS5 can skip through the rows of
+    # whole words, but has to merge those of every word with a prefix.
+    words[-1] += '*'
+    return ' '.join(words)
+
+
+def search(query, accnt_id=None, start=None, end=None, limit=25):
+    """Returns up to ``limit`` ``(row, score)`` pairs for the entries
+    and transfers whose descriptions match ``query`` (see
+    match_expression()), best match first. A higher score is a better
+    match. Rows can be limited to those of one account, and to dates
+    between ``start`` and ``end``.
+
+    Raises SearchUnavailable if the database has no search index.
+    """
+    database = Entry._meta.database
+    if not available(database):
+        raise SearchUnavailable('Search needs SQLite with FTS5.')
+    match = match_expression(query)
+    if match is None:
+        return []
+
+    param = database.interpolation
+    where, params = [], [match]
+    if accnt_id is not None:
+        where.append('(e.assc_accnt_id = {0} OR t.from_accnt_id = {0} OR '
+                     't.to_accnt_id = {0})'.format(param))
+        params.extend([accnt_id] * 3)
+    if start is not None:
+        where.append('COALESCE(e.date, t.date) >= {}'.format(param))
+        params.append(start)
+    if end is not None:
+        where.append('COALESCE(e.date, t.date) <= {}'.format(param))
+        params.append(end)
+    params.append(limit)
+    # bm25() is lower for better matches. The triggers keep every match
+    # in the tables, so these are only joined to filter on.
+    sql = ('SELECT rowid, bm25({fts}) AS score FROM {fts} '
+           'WHERE {fts} MATCH {p}')
+    if where:
+        sql = ('SELECT m.rowid AS rowid, m.score AS score FROM ({}) AS m '
+               'LEFT JOIN {{entry}} AS e '
+               'ON m.rowid % 2 = 0 AND e.id = m.rowid / 2 '
+               'LEFT JOIN {{transfer}} AS t '
+               'ON m.rowid % 2 = 1 AND t.id = m.rowid / 2 '
+               'WHERE {{where}}'.format(sql))
+    cursor = database.execute_sql(
+        (sql + ' ORDER BY score, rowid DESC LIMIT {p}').format(
+            fts=TABLE, entry=Entry._meta.db_table,
+            transfer=Transfer._meta.db_table, p=param,
+            where=' AND '.join(where)),
+        params)
+    matches = cursor.fetchall()
+
+    rows = {}
+    for model, kind in ((Entry, 0), (Transfer, 1)):
+        ids = [rowid // 2 for rowid, score in matches if rowid % 2 == kind]
+        if ids:
+            rows.update(((kind, row.id), row)
+                        for row in model.select().where(model.id << ids))
+    return [(rows[rowid % 2, rowid // 2], -score)
+            for rowid, score in matches]
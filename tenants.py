@@ -0,0 +1,105 @@
+"""One ledger per tenant, each in a SQLite file of its own.
+
+SQLite lets one connection write to a file at a time, so with every
+tenant in one file their writes queue up behind each other. With the
+app's TENANT_DATABASE setting, e.g. ``'tenants/{tenant}.db'``, every
+request is instead for the ledger of the tenant named in its
+TENANT_HEADER header (put there by whatever authenticates users in
+front of the app), and the models are bound to that tenant's database
+for the request (see models.bind_database()). Writes to different
+tenants then only share the disk.
+
+A tenant's file is created, and brought up to date by initialize(),
+the first time it is asked for. TenantDatabases keeps at most
+``max_open`` databases, each with its own connection pool, and retires
+the least recently used to open another (see
+ImmediatePooledSqliteDatabase.retire()): its idle connections are
+closed, and those still in use by a request are closed when it
+returns them.
+"""
+import collections
+import re
+import threading
+
+import metrics
+from models import initialize, PRAGMAS, sqlite_database
+
+# Tenant names become file names, so only these are allowed.
+TENANT_NAME = re.compile(r'[A-Za-z0-9][A-Za-z0-9_-]{0,63}\Z')
+
+_app_lock = threading.Lock()
+
+
+class TenantDatabases(object):
+    """The tenants' databases, by name. ``path`` is formatted with the
+    tenant's name to give the file of its ledger, which is opened with
+    ``pragmas``.
+    """
+    def __init__(self, path, max_open=64, pragmas=PRAGMAS):
+        self.path = path
+        self.max_open = max_open
+        self.pragmas = pragmas
+        self._lock = threading.Lock()
+        self._open = collections.OrderedDict()
+        # Tenants whose files initialize() has been run on.
+        self._initialized = set()
+        # A lock for each tenant being opened, held while its file is
+        # initialized.
+        self._opening = {}
+
+    def get(self, tenant):
+        """Returns the database of ``tenant``, opening it if need be.
+        Raises ValueError if ``tenant`` is not a valid name.
+        """
+        if not tenant or not TENANT_NAME.match(tenant):
+            raise ValueError('Invalid tenant name: {!r}'.format(tenant))
+        with self._lock:
+            database = self._open.get(tenant)
+            if database is not None:
+                self._open.move_to_end(tenant)
+                return database
+            opening = self._opening.setdefault(tenant, threading.Lock())
+        database = sqlite_database(self.path.format(tenant=tenant),
+                                   pragmas=self.pragmas)
+        # Initializing a file only holds up requests for its tenant.
+        with opening:
+            if tenant not in self._initialized:
+                initialize(database)
+                self._initialized.add(tenant)
+        with self._lock:
+            self._opening.pop(tenant, None)
+            opened = self._open.get(tenant)
+            if opened is not None:
+                # Another request opened it in the meantime.
+                database.retire()
+                self._open.move_to_end(tenant)
+                return opened
+            self._open[tenant] = database
+            while len(self._open) > self.max_open:
+                name, evicted = self._open.popitem(last=False)
+                evicted.retire()
+                metrics.TENANT_EVICTIONS.inc()
+            return database
+
+    def close_all(self):
+        """Retires every open database."""
+        with self._lock:
+            while self._open:
+                self._open.popitem()[1].retire()
+
+
+def app_tenants(app):
+    """Returns the app's TenantDatabases, made with its TENANT_DATABASE
+    and TENANT_MAX_OPEN settings, or None if TENANT_DATABASE is not set.
+    """
+    if not app.config.get('TENANT_DATABASE'):
+        return None
+    tenants = app.extensions.get('tenants')
+    if tenants is None:
+        with _app_lock:
+            tenants = app.extensions.get('tenants')
+            if tenants is None:
+                tenants = app.extensions['tenants'] = TenantDatabases(
+                    app.config['TENANT_DATABASE'],
+                    max_open=app.config['TENANT_MAX_OPEN'])
+    return tenants
@@ -0,0 +1,189 @@
+"""Write-behind queue that group-commits entries and transfers.
+
+Written one per transaction, every entry waits for its own commit, and
+under bursty load requests queue up behind SQLite's single writer.
+With the app's WRITE_BEHIND setting on, single entries and transfers
+are instead put on a WriteQueue. One writer thread takes whatever has
+queued up, at most ``max_batch`` rows and waiting no more than
+``max_latency`` seconds for more after the first, and commits it in
+one transaction through Entry.create_entries() and
+Transfer.create_transfers().
+
+submit() returns a concurrent.futures.Future that holds the new row
+once its transaction has committed, or the exception that stopped it
+from being written. If a batch fails, its rows are retried one
+transaction each, so a bad row only fails its own future. Rows for
+different databases (see tenants.py) are committed separately.
+"""
+import atexit
+import collections
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+from flask import current_app
+
+import metrics
+from models import bound_database, count_inserts, Entry, Transfer
+
+CREATE = {
+    Entry: Entry.create_entry,
+    Transfer: Transfer.create_transfer,
+}
+CREATE_MANY = {
+    Entry: Entry.create_entries,
+    Transfer: Transfer.create_transfers,
+}
+
+# Put on the queue by stop().
+_STOP = object()
+
+_app_lock = threading.Lock()
+
+
+class WriteQueue(object):
+    def __init__(self, max_batch=500, max_latency=0.002):
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Starts the writer thread, unless it is running."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='ledger-writer', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """Commits everything submitted so far and stops the writer
+        thread. A later submit() starts it again.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def submit(self, model, **row):
+        """Queues an Entry or a Transfer, given the arguments of its
+        create_entry() or create_transfer(), and returns its Future.
+        """
+        future = Future()
+        self.start()
+        # The row goes to the database the model is bound to in this
+        # thread, not in the writer thread.
+        self._queue.put((model._meta.database, (model, row, future)))
+        return future
+
+    def _take(self):
+        """Waits for the next write, and returns it together with those
+        that follow within max_latency, up to max_batch of them.
+        """
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_latency
+        while batch[-1] is not _STOP and len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            by_database = collections.OrderedDict()
+            for item in batch:
+                if item is not _STOP:
+                    by_database.setdefault(item[0], []).append(item[1])
+            for database, writes in by_database.items():
+                try:
+                    self._commit(database, writes)
+                except Exception as e:
+                    # E.g. no connection could be had. The thread
+                    # carries on.
+                    for model, row, future in writes:
+                        if not future.done():
+                            future.set_exception(e)
+            if batch[-1] is _STOP:
+                return
+
+    def _commit(self, database, writes):
+        with bound_database(database):
+            opened = database.is_closed()
+            if opened:
+                database.connect()
+            try:
+                try:
+                    with database.transaction():
+                        rows = _write(writes)
+                except Exception:
+                    for write in writes:
+                        _commit_one(write)
+                    return
+                metrics.WRITE_BATCH_ROWS.observe(len(writes))
+                count_inserts(rows)
+                for (model, row, future), result in zip(writes, rows):
+                    future.set_result(result)
+            finally:
+                if opened:
+                    database.close()
+
+
+def _write(writes):
+    """Creates the rows of ``writes``, and returns them in order."""
+    rows = [None] * len(writes)
+    for model, create_many in CREATE_MANY.items():
+        indexes = [i for i, write in enumerate(writes) if write[0] is model]
+        if indexes:
+            created = create_many([writes[i][1] for i in indexes])
+            for i, row in zip(indexes, created):
+                rows[i] = row
+    return rows
+
+
+def _commit_one(write):
+    model, row, future = write
+    try:
+        result = CREATE[model](**row)
+    except Exception as e:
+        future.set_exception(e)
+    else:
+        metrics.WRITE_BATCH_ROWS.observe(1)
+        future.set_result(result)
+
+
+def app_queue(app):
+    """Returns the app's WriteQueue, made with its WRITE_QUEUE_MAX_BATCH
+    and WRITE_QUEUE_MAX_LATENCY settings.
+    """
+    write_queue = app.extensions.get('write_queue')
+    if write_queue is None:
+        with _app_lock:
+            write_queue = app.extensions.get('write_queue')
+            if write_queue is None:
+                write_queue = app.extensions['write_queue'] = WriteQueue(
+                    max_batch=app.config['WRITE_QUEUE_MAX_BATCH'],
+                    max_latency=app.config['WRITE_QUEUE_MAX_LATENCY'])
+                # Commit what is queued before the process exits.
+                atexit.register(write_queue.stop)
+    return write_queue
+
+
+def write(model, **row):
+    """Creates an Entry or a Transfer, through the current app's write
+    queue if its WRITE_BEHIND setting is on. Either way the row has been
+    committed when this returns.
+    """
+    app = current_app._get_current_object()
+    if not app.config.get('WRITE_BEHIND'):
+        return CREATE[model](**row)
+    return app_queue(app).submit(model, **row).result(
+        app.config['WRITE_QUEUE_TIMEOUT'])